@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Redaction throughput benchmark
+
+Measures lines/sec of `filter_datum`, `redact_many`,
+`RedactingFormatter.format`, `format_batch` and of the loggers built by
+`get_logger` on synthetic `user_data.csv`-shaped lines, for several
+field counts and value lengths, and the per-line latency of the line by
+line cases.
+
+Throughput is timed around the whole loop, with no per-line timer, so
+line by line and batch cases compare fairly; latencies are sampled in
+a separate pass.
+
+Usage: ./benchmark.py [-n lines] [-o results.json] [-b baseline.json]
+                      [-t tolerance]
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import string
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+filtered_logger = __import__('filtered_logger')
+
+BATCH_TARGET_SPEEDUP = 1.05
+REGRESSION_TOLERANCE = 0.10
+FIELD_COUNTS = (4, 8, 16)
+VALUE_LENGTHS = (8, 64, 256)
+SEED = 0
+
+
+def synthetic_lines(count: int, field_count: int,
+                    value_length: int) -> List[str]:
+    """Builds `count` log lines of `field_count` fields shaped like the
+    columns of `user_data.csv`, with values of `value_length` characters
+    """
+    rng = random.Random(SEED)
+    columns = list(filtered_logger.COLUMNS)
+    columns += ["extra_{}".format(i)
+                for i in range(field_count - len(columns))]
+    columns = columns[:field_count]
+    alphabet = string.ascii_letters + string.digits + "@.-:/ "
+    lines = []
+    for _ in range(count):
+        lines.append("".join(
+            "{}={};".format(column, "".join(
+                rng.choice(alphabet) for _ in range(value_length)))
+            for column in columns))
+    return lines
+
+
+def latencies(run: Callable[[str], object], lines: List[str]) -> List[int]:
+    """Returns the latency of `run` on each line, in nanoseconds"""
+    clock = time.perf_counter_ns
+    result = []
+    for line in lines:
+        start = clock()
+        run(line)
+        result.append(clock() - start)
+    return result
+
+
+def summary(count: int, elapsed: float,
+            samples: Optional[List[int]] = None) -> Dict[str, float]:
+    """Computes the throughput of a run, and the latency percentiles of
+    its `samples` if any
+    """
+    result = {"lines_per_sec": count / elapsed}
+    if samples:
+        samples = sorted(samples)
+        result["p50_us"] = samples[len(samples) // 2] / 1000
+        result["p99_us"] = samples[min(len(samples) - 1,
+                                       len(samples) * 99 // 100)] / 1000
+    return result
+
+
+def measure(run: Callable[[str], object], lines: List[str]
+            ) -> Dict[str, float]:
+    """Measures `run` line by line"""
+    start = time.perf_counter()
+    for line in lines:
+        run(line)
+    elapsed = time.perf_counter() - start
+    return summary(len(lines), elapsed, latencies(run, lines))
+
+
+def measure_batch(run: Callable[[List[str]], object], lines: List[str],
+                  batch_size: int = 1000) -> Dict[str, float]:
+    """Measures `run` batch by batch
+
+    The latency of a line inside a batch can't be observed, so none is
+    reported.
+    """
+    start = time.perf_counter()
+    for i in range(0, len(lines), batch_size):
+        run(lines[i:i + batch_size])
+    return summary(len(lines), time.perf_counter() - start)
+
+
+def open_logger(devnull, **kwargs) -> logging.Logger:
+    """Builds a logger with `get_logger`, writing to `devnull`"""
+    logger = filtered_logger.get_logger(**kwargs)
+    handler = logger.handlers[-1]
+    listener = getattr(handler, "listener", None)
+    if listener is None:
+        handler.setStream(devnull)
+    else:
+        listener.handlers[0].setStream(devnull)
+    return logger
+
+
+def close_logger(logger: logging.Logger) -> None:
+    """Closes the handler added by `open_logger`, draining its queue"""
+    handler = logger.handlers[-1]
+    handler.close()
+    logger.removeHandler(handler)
+
+
+def measure_logger(lines: List[str], devnull, **kwargs) -> Dict[str, float]:
+    """Measures a logger from `get_logger` writing to `devnull`
+
+    With an asynchronous logger the latency is the time to queue a line
+    and the throughput includes draining the queue.
+    """
+    logger = open_logger(devnull, **kwargs)
+    start = time.perf_counter()
+    for line in lines:
+        logger.info(line)
+    close_logger(logger)
+    elapsed = time.perf_counter() - start
+    logger = open_logger(devnull, **kwargs)
+    samples = latencies(logger.info, lines)
+    close_logger(logger)
+    return summary(len(lines), elapsed, samples)
+
+
+def run_suite(count: int) -> Dict[str, object]:
+    """Runs every benchmark case and returns the results"""
+    fields = filtered_logger.PII_FIELDS
+    formatter = filtered_logger.RedactingFormatter(fields=fields)
+    results = []
+    with open(os.devnull, "w") as devnull:
+        for field_count in FIELD_COUNTS:
+            for value_length in VALUE_LENGTHS:
+                lines = synthetic_lines(count, field_count, value_length)
+                records = {line: logging.LogRecord(
+                    "user_data", logging.INFO, None, None, line, None, None)
+                    for line in lines}
+                cases = {
+                    "filter_datum": measure(
+                        lambda line: filtered_logger.filter_datum(
+                            fields, "***", line, ";"), lines),
+                    "redact_many": measure_batch(
+                        lambda batch: filtered_logger.redact_many(
+                            fields, "***", batch, ";"), lines),
+                    "format": measure(
+                        lambda line: formatter.format(records[line]),
+                        lines),
+                    "format_batch": measure_batch(
+                        lambda batch: formatter.format_batch(
+                            [records[line] for line in batch]), lines),
+                    "get_logger": measure_logger(lines, devnull),
+                    "get_logger_async": measure_logger(
+                        lines, devnull, asynchronous=True),
+                }
+                for target, result in cases.items():
+                    result.update({
+                        "target": target,
+                        "field_count": field_count,
+                        "value_length": value_length,
+                        "line_length": sum(map(len, lines)) // len(lines),
+                    })
+                    results.append(result)
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "lines": count,
+        "results": results,
+    }
+
+
+def batch_speedup(report: Dict[str, object]) -> float:
+    """Returns the mean redact_many over filter_datum throughput ratio"""
+    rates = {}
+    for result in report["results"]:
+        case = (result["field_count"], result["value_length"])
+        rates.setdefault(case, {})[result["target"]] = \
+            result["lines_per_sec"]
+    ratios = [rate["redact_many"] / rate["filter_datum"]
+              for rate in rates.values()]
+    return sum(ratios) / len(ratios)
+
+
+def case_key(result: Dict[str, object]) -> tuple:
+    """Identifies the case of a result"""
+    return (result["target"], result["field_count"], result["value_length"])
+
+
+def regressions(report: Dict[str, object], baseline: Dict[str, object],
+                tolerance: float = REGRESSION_TOLERANCE) -> List[str]:
+    """Lists the cases more than `tolerance` slower than in `baseline`"""
+    previous = {case_key(result): result for result in baseline["results"]}
+    slower = []
+    for result in report["results"]:
+        old = previous.get(case_key(result))
+        if old is None:
+            continue
+        ratio = result["lines_per_sec"] / old["lines_per_sec"]
+        if ratio < 1 - tolerance:
+            slower.append("{} fields={} length={}: {:.0%} of baseline".format(
+                *case_key(result), ratio))
+    return slower
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Runs the suite, saves its results and checks them"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the redaction hot path")
+    parser.add_argument("-n", "--lines", type=int, default=20000,
+                        help="lines per case")
+    parser.add_argument("-o", "--output",
+                        help="JSON file the results are saved to")
+    parser.add_argument("-b", "--baseline",
+                        help="JSON results of a previous run to compare to")
+    parser.add_argument("-t", "--tolerance", type=float,
+                        default=REGRESSION_TOLERANCE,
+                        help="throughput drop reported as a regression")
+    args = parser.parse_args(argv)
+
+    report = run_suite(args.lines)
+    report["batch_speedup"] = batch_speedup(report)
+    for result in report["results"]:
+        line = "{:<17} fields={:<3} length={:<4} {:>10,.0f} lines/sec".format(
+            result["target"], result["field_count"], result["value_length"],
+            result["lines_per_sec"])
+        if "p99_us" in result:
+            line += " p50={:>8.2f}us p99={:>8.2f}us".format(
+                result["p50_us"], result["p99_us"])
+        print(line)
+    print("batch speedup: {:.2f}x (target {:.2f}x)".format(
+        report["batch_speedup"], BATCH_TARGET_SPEEDUP))
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    failed = report["batch_speedup"] < BATCH_TARGET_SPEEDUP
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for line in slower:
+            print("regression: {}".format(line))
+        failed = failed or len(slower) > 0
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
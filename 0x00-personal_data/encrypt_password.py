@@ -2,15 +2,68 @@
 """Password Encryption Module"""
 
 import bcrypt
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, Iterable, Iterator, Optional, Tuple
 
+TARGET_MS = float(os.environ.get("BCRYPT_TARGET_MS", 250))
+MIN_ROUNDS = int(os.environ.get("BCRYPT_MIN_ROUNDS", 12))
+MAX_ROUNDS = int(os.environ.get("BCRYPT_MAX_ROUNDS", 16))
+PROBE_ROUNDS = 8
 
-def hash_password(password: str) -> bytes:
+_rounds = None
+_rounds_lock = threading.Lock()
+
+
+def calibrate_rounds(target_ms: float = TARGET_MS,
+                     min_rounds: int = MIN_ROUNDS,
+                     max_rounds: int = MAX_ROUNDS) -> int:
+    """
+    Finds the bcrypt cost whose hashes take about `target_ms` on this
+    machine
+
+    A hash is timed at a low cost; each extra round doubles the work,
+    which gives the cost closest to the target. The result is kept
+    between `min_rounds`, the security floor, and `max_rounds`.
+    """
+    elapsed = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        bcrypt.hashpw(b"calibration", bcrypt.gensalt(PROBE_ROUNDS))
+        elapsed = min(elapsed, time.perf_counter() - start)
+    rounds = PROBE_ROUNDS + round(math.log2(target_ms / 1000 / elapsed))
+    return max(min_rounds, min(max_rounds, rounds))
+
+
+def get_rounds() -> int:
+    """
+    Returns the bcrypt cost used for new hashes: the `BCRYPT_ROUNDS`
+    environment variable if set, otherwise the cost calibrated on first
+    use; both are kept between `MIN_ROUNDS` and `MAX_ROUNDS`
+    """
+    global _rounds
+    with _rounds_lock:
+        if _rounds is None:
+            if os.environ.get("BCRYPT_ROUNDS"):
+                rounds = int(os.environ["BCRYPT_ROUNDS"])
+                _rounds = max(MIN_ROUNDS, min(MAX_ROUNDS, rounds))
+            else:
+                _rounds = calibrate_rounds()
+        return _rounds
+
+
+def hash_password(password: str, rounds: Optional[int] = None) -> bytes:
     """
     Encrypts or hashes a password and
     returns the hashed password.
+    The bcrypt cost is `rounds`, or `get_rounds()` if not given.
     """
     pwd = bytes(password, "utf-8")
-    hashed = bcrypt.hashpw(pwd, bcrypt.gensalt())
+    hashed = bcrypt.hashpw(pwd, bcrypt.gensalt(rounds or get_rounds()))
     return hashed
 
 
@@ -23,3 +76,97 @@ def is_valid(hashed_password: bytes, password: str) -> bool:
     """
     pwd = bytes(password, "utf-8")
     return bcrypt.checkpw(pwd, hashed_password)
+
+
+def hash_rounds(hashed_password: bytes) -> int:
+    """Returns the bcrypt cost of a hashed password"""
+    return int(hashed_password.split(b"$")[2])
+
+
+def needs_rehash(hashed_password: bytes) -> bool:
+    """
+    Checks if a hashed password uses a lower cost than new hashes
+
+    A higher cost is kept: the cost is calibrated per machine, and a
+    host calibrating lower must not weaken hashes made elsewhere.
+    """
+    return hash_rounds(hashed_password) < get_rounds()
+
+
+def verify_and_rehash(hashed_password: bytes,
+                      password: str) -> Tuple[bool, Optional[bytes]]:
+    """
+    Checks a password like `is_valid`, rehashing it when its hash uses
+    a lower cost than new hashes
+    Return:
+    `(False, None)` if the passwords don't match
+    `(True, None)` if they match and the hash is up to date
+    `(True, new_hash)` if they match and the hash should be replaced
+    by `new_hash`
+    """
+    if not is_valid(hashed_password, password):
+        return False, None
+    if not needs_rehash(hashed_password):
+        return True, None
+    return True, hash_password(password)
+
+
+def hash_passwords(passwords: Iterable[str],
+                   workers: Optional[int] = None,
+                   max_in_flight: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Hashes many passwords across a pool of processes
+
+    Args:
+    `passwords`    : the passwords to hash
+    `workers`      : the number of processes (default: CPU count)
+    `max_in_flight`: the maximum number of passwords submitted but not
+                     yielded yet (default: twice `workers`)
+
+    Return: The hashed passwords, in the order of `passwords`
+    """
+    rounds = get_rounds()
+    args = ((password, rounds) for password in passwords)
+    return _pool_map(hash_password, args, workers, max_in_flight)
+
+
+def verify_many(pairs: Iterable[Tuple[bytes, str]],
+                workers: Optional[int] = None,
+                max_in_flight: Optional[int] = None) -> Iterator[bool]:
+    """
+    Checks many (hashed password, password) pairs across a pool of
+    processes
+
+    Args:
+    `pairs`        : the hashed passwords and the passwords to check
+    `workers`      : the number of processes (default: CPU count)
+    `max_in_flight`: the maximum number of pairs submitted but not
+                     yielded yet (default: twice `workers`)
+
+    Return: What `is_valid` returns for each pair, in the order of `pairs`
+    """
+    return _pool_map(is_valid, pairs, workers, max_in_flight)
+
+
+def _pool_map(function: Callable, args: Iterable[tuple],
+              workers: Optional[int],
+              max_in_flight: Optional[int]) -> Iterator:
+    """Calls `function` on each argument tuple in a process pool and
+    yields the results in order, with a bounded number of calls pending
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * workers
+    with ProcessPoolExecutor(workers) as executor:
+        yield from _ordered(executor, function, args, max_in_flight)
+
+
+def _ordered(executor: Executor, function: Callable, args: Iterable[tuple],
+             max_in_flight: int) -> Iterator:
+    """Submits calls to `executor` and yields their results in order"""
+    pending = deque()
+    for arg in args:
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+        pending.append(executor.submit(function, *arg))
+    while pending:
+        yield pending.popleft().result()
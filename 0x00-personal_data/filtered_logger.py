@@ -1,26 +1,105 @@
 #!/usr/bin/env python3
 """Log message obfuscating module"""
 
+import argparse
+import copy
+import json
+import multiprocessing
 import re
 import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import mysql.connector
-from typing import List
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import (Callable, Collection, Iterable, Iterator, List,
+                    Mapping, Optional, Pattern, TextIO, Tuple)
 import logging
+from logging.handlers import QueueHandler, QueueListener
 
 PII_FIELDS = ('name', 'email', 'phone', 'ssn', 'password')
+COLUMNS = ('name', 'email', 'phone', 'ssn', 'password',
+           'ip', 'last_login', 'user_agent')
+EXPORT_BATCH_SIZE = 1000
+PROGRESS_EVERY = 100000
+WRITE_BUFFER_SIZE = 1 << 20
+ENGINE_CACHE_SIZE = 128
+QUEUE_SIZE = 10000
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'sample')
+POOL_SIZE = 5
+STRUCTURED_ATTRIBUTE = 'data'
+JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"')
+JSON_NESTING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]')
+JSON_SCALAR = re.compile(r'[^,}\]\s]*')
 
+_pool = None
+_pool_lock = threading.Lock()
 
-def get_logger() -> logging.Logger:
-    """Creates a logger and returns it"""
+
+def get_logger(asynchronous: bool = False, queue_size: int = QUEUE_SIZE,
+               overflow: str = 'block', sample_rate: int = 10
+               ) -> logging.Logger:
+    """
+    Creates a logger and returns it
+
+    Args:
+    `asynchronous`: if True, records are handed to a bounded queue and
+                    redacted and written by a background thread
+    `queue_size`  : the maximum number of records waiting in the queue
+    `overflow`    : what to do with a record when the queue is full,
+                    one of `OVERFLOW_POLICIES`
+    `sample_rate` : with the `sample` policy, one record out of
+                    `sample_rate` is still queued while the queue is
+                    full, if room was made for it; the others are dropped
+
+    Return: The `user_data` logger
+    """
+    if overflow not in OVERFLOW_POLICIES:
+        raise ValueError("overflow must be one of {}".format(
+            ", ".join(OVERFLOW_POLICIES)))
     logger = logging.getLogger('user_data')
     logger.setLevel(logging.INFO)
     logger.propagate = False
     stream_handler = logging.StreamHandler()
     stream_handler.setFormatter(RedactingFormatter(PII_FIELDS))
-    logger.addHandler(stream_handler)
+    if not asynchronous:
+        logger.addHandler(stream_handler)
+        return logger
+    queue_handler = OverflowQueueHandler(queue.Queue(queue_size),
+                                         overflow, sample_rate)
+    queue_handler.listener = BlockingQueueListener(queue_handler.queue,
+                                                   stream_handler)
+    queue_handler.listener.start()
+    logger.addHandler(queue_handler)
     return logger
 
 
+def structured_data(record: logging.LogRecord) -> Optional[Mapping]:
+    """
+    Returns the structured data of a log record, if it has any
+
+    Structured data is either a mapping passed as `extra={'data': ...}`,
+    or a mapping passed as the only argument of a message with no `%`
+    placeholder, like `logger.info("", {"email": email})`.
+    """
+    # Plain dicts are checked first: isinstance() of a typing alias is
+    # slow
+    data = getattr(record, STRUCTURED_ATTRIBUTE, None)
+    if type(data) is dict or data is not None and isinstance(data, Mapping):
+        return data
+    args = record.args
+    if not args or type(args) is tuple:
+        return None
+    if (type(args) is dict or isinstance(args, Mapping)) and \
+            isinstance(record.msg, str) and "%" not in record.msg:
+        return args
+    return None
+
+
 def get_db() -> mysql.connector.connection.MySQLConnection:
     """Creates a database connector and
     returns the connection object
@@ -34,27 +113,242 @@ def get_db() -> mysql.connector.connection.MySQLConnection:
     return mydb
 
 
-def main() -> None:
-    """Logs user record information
+def get_pool() -> 'ConnectionPool':
+    """Returns the process-wide database connection pool, sized by
+    the `PERSONAL_DATA_DB_POOL_SIZE` environment variable
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
+
+
+def row_message(row: Tuple) -> str:
+    """Builds the log message of a `users` table row"""
+    return "{};".format("; ".join(
+        "{}={}".format(column, value) for column, value in zip(COLUMNS, row)))
+
+
+def export_users(output: TextIO = sys.stdout,
+                 batch_size: int = EXPORT_BATCH_SIZE,
+                 progress: Optional[TextIO] = None,
+                 progress_every: int = PROGRESS_EVERY) -> int:
+    """
+    Streams the redacted `users` table as log lines
+
+    Args:
+    `output`        : where the log lines are written
+    `batch_size`    : the number of rows fetched and written at once
+    `progress`      : where progress reports are written, if anywhere
+    `progress_every`: the number of rows between two progress reports
+
+    Return: The number of exported rows
+    """
+    db = get_db()
+    # An unbuffered cursor streams rows from the server instead of
+    # loading the whole result set into memory
+    cursor = db.cursor(buffered=False)
+    count = 0
+    reported = 0
+    start = time.perf_counter()
+    try:
+        cursor.execute("SELECT * FROM users;")
+        for rows, text in redacted_batches(cursor, batch_size):
+            output.write(text)
+            count += rows
+            if progress is not None and count - reported >= progress_every:
+                reported = count
+                report_progress(progress, count, start)
+    finally:
+        cursor.close()
+        db.close()
+    output.flush()
+    if progress is not None:
+        report_progress(progress, count, start)
+    return count
+
+
+def redacted_batches(cursor, batch_size: int) -> Iterator[Tuple[int, str]]:
+    """Yields the number of rows and the redacted log lines of each
+    batch of rows fetched from an executed `cursor`
+    """
+    formatter = RedactingFormatter(fields=PII_FIELDS)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        records = [logging.LogRecord("user_data", logging.INFO, None,
+                                     None, row_message(row), None, None)
+                   for row in rows]
+        lines = formatter.format_batch(records)
+        lines.append("")
+        yield len(rows), "\n".join(lines)
+
+
+def export_shard(shard: Tuple[int, int, int, str]) -> int:
     """
-    columns = ("name", "email", "phone", "ssn", "password",
-               "ip", "last_login", "user_agent")
+    Redacts one hash shard of the `users` table into a file, on its own
+    database connection
+
+    Args:
+    `shard`: the shard number, the number of shards, the fetch batch size
+             and the file to write to
+
+    Return: The number of exported rows
+    """
+    number, shards, batch_size, path = shard
     db = get_db()
-    cursor = db.cursor()
-    cursor.execute("SELECT * FROM users;")
-    for row in cursor:
-        record = map(
-            lambda x: "{}={}".format(x[0], x[1]),
-            zip(columns, row)
-        )
-        msg = "{};".format("; ".join(list(record)))
-        log_record = logging.LogRecord("user_data", logging.INFO, None,
-                                       None, msg, None, None)
-        formatter = RedactingFormatter(fields=("name", "email",
-                                       "phone", "ssn", "password"))
-        print(formatter.format(log_record))
-    cursor.close()
-    db.close()
+    cursor = db.cursor(buffered=False)
+    try:
+        # The table has no key column to split it into ranges: rows are
+        # spread across shards by a hash of their columns, so each shard
+        # is one scan of the table, with no sort and no rows to skip
+        cursor.execute("SELECT * FROM users WHERE MOD(CRC32(CONCAT_WS(',', "
+                       "{})), %s) = %s;".format(", ".join(COLUMNS)),
+                       (shards, number))
+        count = 0
+        with open(path, "w", buffering=WRITE_BUFFER_SIZE) as output:
+            for rows, text in redacted_batches(cursor, batch_size):
+                output.write(text)
+                count += rows
+        return count
+    finally:
+        cursor.close()
+        db.close()
+
+
+def export_users_parallel(workers: int, output: TextIO = sys.stdout,
+                          batch_size: int = EXPORT_BATCH_SIZE,
+                          progress: Optional[TextIO] = None,
+                          shard_path: Optional[str] = None) -> int:
+    """
+    Redacts the `users` table in one shard per worker process
+
+    Args:
+    `workers`   : the number of worker processes
+    `output`    : where the log lines are written, one shard after the
+                  other
+    `batch_size`: the number of rows each worker fetches at once
+    `progress`  : where progress reports are written, if anywhere
+    `shard_path`: if set, each worker writes its shard to
+                  `shard_path.<shard number>` instead of `output`
+
+    Return: The number of exported rows
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        prefix = shard_path
+        if prefix is None:
+            prefix = os.path.join(directory, "shard")
+        shards = [(number, workers, batch_size,
+                   "{}.{:05d}".format(prefix, number))
+                  for number in range(workers)]
+        count = 0
+        start = time.perf_counter()
+        with multiprocessing.Pool(workers) as pool:
+            for shard, rows in zip(shards, pool.imap(export_shard, shards)):
+                count += rows
+                if shard_path is None:
+                    with open(shard[3]) as text:
+                        shutil.copyfileobj(text, output, WRITE_BUFFER_SIZE)
+                if progress is not None:
+                    report_progress(progress, count, start)
+    output.flush()
+    return count
+
+
+def report_progress(progress: TextIO, count: int, start: float) -> None:
+    """Writes the number of exported rows and the export rate"""
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed if elapsed > 0 else 0.0
+    progress.write("exported {} rows in {:.1f}s ({:.0f} rows/sec)\n".format(
+        count, elapsed, rate))
+    progress.flush()
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Logs user record information
+    """
+    parser = argparse.ArgumentParser(
+        description="Export the users table as redacted log lines")
+    parser.add_argument("-o", "--output",
+                        help="file to write to (default: stdout)")
+    parser.add_argument("-b", "--batch-size", type=int,
+                        default=EXPORT_BATCH_SIZE,
+                        help="rows fetched and written at once")
+    parser.add_argument("-p", "--progress", action="store_true",
+                        help="report progress and rows/sec on stderr")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="worker processes redacting table shards")
+    parser.add_argument("--per-shard", action="store_true",
+                        help="write each shard to OUTPUT.<shard number>")
+    args = parser.parse_args(argv)
+    if args.per_shard and args.output is None:
+        parser.error("--per-shard requires --output")
+    progress = sys.stderr if args.progress else None
+    if args.per_shard:
+        export_users_parallel(args.workers, sys.stdout, args.batch_size,
+                              progress, args.output)
+    elif args.output is None:
+        export(sys.stdout, args, progress)
+    else:
+        with open(args.output, "w", buffering=WRITE_BUFFER_SIZE) as output:
+            export(output, args, progress)
+
+
+def export(output: TextIO, args: argparse.Namespace,
+           progress: Optional[TextIO]) -> int:
+    """Runs the serial or parallel export selected on the command line"""
+    if args.workers > 1:
+        return export_users_parallel(args.workers, output, args.batch_size,
+                                     progress)
+    return export_users(output, args.batch_size, progress)
+
+
+class RedactionEngine:
+    """ Redacts a fixed set of fields in a single scan of a log line
+    """
+
+    def __init__(self, fields: Tuple[str, ...], redaction: str,
+                 separator: str):
+        self.fields = fields
+        self.redaction = redaction
+        self.separator = separator
+        self.pattern = None
+        if len(fields) > 0:
+            # Anchoring on "=" lets the regex engine jump from one "=" to
+            # the next; the look-behinds then tell which field it ends
+            keys = "|".join("(?<={}=)".format(field) for field in fields)
+            self.pattern = re.compile(r"=(?:{})[^{}]*".format(
+                keys, separator))
+        self.replacement = "=" + redaction
+
+    def redact(self, message: str) -> str:
+        """Obfuscates every field of `message` at once"""
+        if self.pattern is None:
+            return message
+        return self.pattern.sub(self.replacement, message)
+
+    def redact_many(self, messages: Iterable[str]) -> List[str]:
+        """Obfuscates a batch of log lines
+
+        The compiled pattern and replacement are looked up once for the
+        whole batch instead of once per line.
+        """
+        if self.pattern is None:
+            return list(messages)
+        sub = self.pattern.sub
+        replacement = self.replacement
+        return [sub(replacement, message) for message in messages]
+
+
+@lru_cache(maxsize=ENGINE_CACHE_SIZE)
+def get_engine(fields: Tuple[str, ...], redaction: str,
+               separator: str) -> RedactionEngine:
+    """Returns the (cached) redaction engine of a fields/redaction/separator
+    combination, compiling it on first use
+    """
+    return RedactionEngine(fields, redaction, separator)
 
 
 def filter_datum(fields: List[str], redaction: str,
@@ -71,10 +365,92 @@ def filter_datum(fields: List[str], redaction: str,
 
     Return: The log message obfuscated
     """
-    for field in fields:
-        message = re.sub(r"{}=[^{}]*".format(field, separator),
-                         "{}={}".format(field, redaction), message)
-    return message
+    engine = get_engine(tuple(fields), redaction, separator)
+    return engine.redact(message)
+
+
+def redact_many(fields: List[str], redaction: str,
+                lines: Iterable[str], separator: str) -> List[str]:
+    """
+    Obfuscates a batch of log messages
+
+    Args:
+    `fields`   : a list of strings representing all fields to obfuscate
+    `redaction`: a string representing by what the field will be obfuscated
+    `lines`    : the log lines to obfuscate
+    `separator`: a string representing by which character is separating
+                 all fields in a log line
+
+    Return: The obfuscated log messages, in the order of `lines`
+    """
+    engine = get_engine(tuple(fields), redaction, separator)
+    return engine.redact_many(lines)
+
+
+@lru_cache(maxsize=ENGINE_CACHE_SIZE)
+def json_key_pattern(fields: Tuple[str, ...]) -> Pattern:
+    """Compiles the pattern of the JSON object keys in `fields`"""
+    # Quotes inside JSON strings are escaped, so a quote not preceded
+    # by a backslash always delimits a string
+    return re.compile(r'(?<!\\)"(?:{})"\s*:\s*'.format(
+        "|".join(re.escape(field) for field in fields)))
+
+
+def iter_redacted_json(text: str, fields: Collection[str],
+                       redaction: str) -> Iterator[str]:
+    """
+    Yields the pieces of `text` with the values of the JSON keys in
+    `fields` replaced by `redaction`, at any depth
+
+    The text is never decoded into Python objects: the scan jumps from
+    one PII key to the next, and a redacted object or array value is
+    skipped by counting brackets. Keys are matched as written, without
+    decoding escapes. Text around the JSON documents is passed through.
+    """
+    if len(fields) == 0:
+        yield text
+        return
+    pattern = json_key_pattern(tuple(sorted(fields)))
+    replacement = json.dumps(redaction)
+    pos = 0
+    while True:
+        key = pattern.search(text, pos)
+        if key is None:
+            break
+        yield text[pos:key.end()]
+        yield replacement
+        pos = json_value_end(text, key.end())
+    yield text[pos:]
+
+
+def json_value_end(text: str, start: int) -> int:
+    """Returns the offset right after the JSON value starting at `start`"""
+    char = text[start:start + 1]
+    if char == '"':
+        string = JSON_STRING.match(text, start)
+        return len(text) if string is None else string.end()
+    if char not in ("{", "["):
+        return JSON_SCALAR.match(text, start).end()
+    depth = 0
+    for token in JSON_NESTING.finditer(text, start):
+        bracket = token.group()
+        if bracket in ("{", "["):
+            depth += 1
+        elif bracket in ("}", "]"):
+            depth -= 1
+            if depth == 0:
+                return token.end()
+    return len(text)
+
+
+def redact_json(text: str, fields: Collection[str],
+                redaction: str) -> str:
+    """Obfuscates the values of the JSON keys in `fields` at any depth
+    of the JSON documents found in `text`
+    """
+    if '"' not in text:
+        return text
+    return "".join(iter_redacted_json(text, fields, redaction))
 
 
 class RedactingFormatter(logging.Formatter):
@@ -85,15 +461,290 @@ class RedactingFormatter(logging.Formatter):
     FORMAT = "[HOLBERTON] %(name)s %(levelname)s %(asctime)-15s: %(message)s"
     SEPARATOR = ";"
 
-    def __init__(self, fields: List[str]):
+    def __init__(self, fields: List[str], json_payloads: bool = False):
+        """
+        Args:
+        `fields`       : the fields to obfuscate
+        `json_payloads`: if True, the values of these fields are also
+                         obfuscated in the JSON documents of log lines
+        """
         super(RedactingFormatter, self).__init__(self.FORMAT)
         self.fields = fields
+        self.field_set = frozenset(fields)
+        self.json_payloads = json_payloads
+        self.engine = get_engine(tuple(fields), self.REDACTION,
+                                 self.SEPARATOR)
 
     def format(self, record: logging.LogRecord) -> str:
         """Formats a log record"""
+        data = structured_data(record)
+        if data is not None:
+            return self.format_structured(record, data)
         msg = super(RedactingFormatter, self).format(record)
-        txt = filter_datum(self.fields, self.REDACTION, msg, self.SEPARATOR)
-        return txt
+        return self.redact_json(self.engine.redact(msg))
+
+    def format_batch(self, records: Iterable[logging.LogRecord]) -> List[str]:
+        """Formats many log records, redacting them as one batch"""
+        formatter = super(RedactingFormatter, self)
+        lines = []
+        plain = []
+        for record in records:
+            data = structured_data(record)
+            if data is None:
+                plain.append(len(lines))
+                lines.append(formatter.format(record))
+            else:
+                lines.append(self.format_structured(record, data))
+        redacted = self.engine.redact_many([lines[i] for i in plain])
+        for i, line in zip(plain, redacted):
+            lines[i] = self.redact_json(line)
+        return lines
+
+    def redact_json(self, msg: str) -> str:
+        """Obfuscates the JSON payloads of a log line, if enabled"""
+        if not self.json_payloads:
+            return msg
+        return redact_json(msg, self.field_set, self.REDACTION)
+
+    def render(self, data: Mapping) -> str:
+        """Renders structured data as `field=value;` pairs, redacting the
+        PII fields by key instead of by pattern
+        """
+        redaction = self.REDACTION
+        field_set = self.field_set
+        separator = self.SEPARATOR
+        # %-formatting is about twice as fast as str.format() here
+        return "".join([
+            "%s=%s%s" % (key, redaction if key in field_set else value,
+                         separator)
+            for key, value in data.items()])
+
+    def format_structured(self, record: logging.LogRecord,
+                          data: Mapping) -> str:
+        """Formats a log record carrying structured data
+
+        Only the record message goes through the redaction patterns; the
+        data is redacted by key, then appended after a space.
+        """
+        message = record.getMessage()
+        if message:
+            message = self.redact_json(self.engine.redact(message))
+        rendered = self.render(data)
+        if message and rendered:
+            message = "{} {}".format(message, rendered)
+        record.message = message or rendered
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        s = self.formatMessage(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            s = "{}\n{}".format(s, self.engine.redact(record.exc_text))
+        if record.stack_info:
+            s = "{}\n{}".format(s, self.formatStack(record.stack_info))
+        return s
+
+
+class OverflowQueueHandler(QueueHandler):
+    """ Queue handler applying an overflow policy to a bounded queue
+    """
+
+    def __init__(self, log_queue: queue.Queue, overflow: str = 'block',
+                 sample_rate: int = 10):
+        super(OverflowQueueHandler, self).__init__(log_queue)
+        self.overflow = overflow
+        self.sample_rate = max(1, sample_rate)
+        self.listener = None
+        self.dropped = 0
+        self._overflowed = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        """Prepares a record for the queue, keeping structured data for
+        the listener to render
+        """
+        data = structured_data(record)
+        if data is not None and data is record.args:
+            return copy.copy(record)
+        return super(OverflowQueueHandler, self).prepare(record)
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        """Queues a record, applying the overflow policy if the queue
+        is full
+        """
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+            return
+        except queue.Full:
+            pass
+        if self.overflow == 'sample':
+            self._overflowed += 1
+            if self._overflowed % self.sample_rate == 0:
+                # The sampled record only gets in if the listener has
+                # made room since, the caller never waits
+                try:
+                    self.queue.put_nowait(record)
+                    return
+                except queue.Full:
+                    pass
+            self.dropped += 1
+            return
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(record)
+                return
+            except queue.Full:
+                continue
+
+    def close(self) -> None:
+        """Stops the listener once every queued record is written
+
+        `logging.shutdown` closes handlers at exit, so queued records
+        are flushed when the interpreter stops.
+        """
+        listener, self.listener = self.listener, None
+        if listener is not None:
+            listener.stop()
+        super(OverflowQueueHandler, self).close()
+
+
+class BlockingQueueListener(QueueListener):
+    """ Queue listener that waits for room in a full queue on stop
+    """
+
+    def enqueue_sentinel(self) -> None:
+        """Queues the stop sentinel behind the pending records"""
+        self.queue.put(self._sentinel)
+
+
+class ConnectionPool:
+    """ Pool of reusable database connections
+    """
+
+    def __init__(self, size: Optional[int] = None,
+                 connect: Callable[[], object] = get_db):
+        """
+        Args:
+        `size`   : the maximum number of open connections, read from the
+                   `PERSONAL_DATA_DB_POOL_SIZE` environment variable
+                   when not given
+        `connect`: the function opening a new connection
+        """
+        if size is None:
+            size = int(os.environ.get('PERSONAL_DATA_DB_POOL_SIZE',
+                                      POOL_SIZE))
+        if size < 1:
+            raise ValueError("pool size must be at least 1")
+        self.size = size
+        self.connect = connect
+        self.closed = False
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def acquire(self, timeout: Optional[float] = None):
+        """Checks a connection out of the pool
+
+        Idle connections failing their health check are closed and
+        replaced by a new one.
+        """
+        if self.closed:
+            raise RuntimeError("connection pool is closed")
+        if not self._slots.acquire(timeout=timeout):
+            raise TimeoutError("no database connection available")
+        try:
+            while True:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    return self.connect()
+                if self._is_healthy(conn):
+                    return conn
+                self._close(conn)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, conn) -> None:
+        """Returns a checked out connection to the pool
+
+        The session is reset first, so an open transaction or unread
+        result doesn't leak to the next borrower; a connection that
+        can't be reset is closed instead.
+        """
+        try:
+            if self.closed or not self._reset(conn):
+                self._close(conn)
+            else:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self, timeout: Optional[float] = None):
+        """Checks a connection out for the duration of a `with` block"""
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self) -> None:
+        """Closes the idle connections; checked out connections are
+        closed when they are released
+        """
+        self.closed = True
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+    def __enter__(self) -> 'ConnectionPool':
+        """Uses the pool as a context manager"""
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        """Closes the pool on leaving a `with` block"""
+        self.close()
+
+    @staticmethod
+    def _is_healthy(conn) -> bool:
+        """Pings a connection"""
+        try:
+            return conn.is_connected()
+        except Exception:
+            return False
+
+    @staticmethod
+    def _reset(conn) -> bool:
+        """Resets the session of a connection, or rolls back its
+        transaction when it can't reset it, and tells if it worked
+        """
+        try:
+            reset_session = getattr(conn, "reset_session", None)
+            if reset_session is not None:
+                reset_session()
+            else:
+                conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(conn) -> None:
+        """Closes a connection, ignoring errors of dead connections"""
+        try:
+            conn.close()
+        except Exception:
+            pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""Redacts the PII columns of large `user_data.csv`-style dumps
+
+Usage: ./redact_csv.py user_data.csv [-o redacted.csv] [-w workers]
+"""
+
+import argparse
+import csv
+import mmap
+import os
+import re
+import sys
+from collections import deque
+from multiprocessing import Pool
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from filtered_logger import PII_FIELDS, RedactingFormatter
+
+CHUNK_SIZE = 8 << 20
+WRITE_BUFFER_SIZE = 1 << 20
+# A quoted CSV field (with "" escapes) or a bare one, on a single line
+CSV_FIELD = rb'("[^"\r\n]*(?:""[^"\r\n]*)*"|[^,"\r\n]*)'
+# Any field, as written: quoted ones may hold newlines, and like the
+# `csv` module, quotes are only special at the start of a field
+RAW_FIELD = re.compile(rb'"(?:[^"]|"")*"[^,\r\n]*|[^,\r\n]*')
+LINE_END = re.compile(rb'\r\n|\n|\r|$')
+
+_worker = None
+
+
+class ChunkRedactor:
+    """ Redacts the PII columns of chunks of CSV lines
+    """
+
+    def __init__(self, header: bytes, fields: Tuple[str, ...],
+                 redaction: str):
+        self.columns = next(csv.reader([header.decode()]))
+        self.redacted = [column in fields for column in self.columns]
+        self.redaction = redaction
+        # One substitution per line: kept columns are copied back from
+        # their group, redacted ones are replaced by the redaction
+        self.pattern = re.compile(
+            rb"^" + rb",".join([CSV_FIELD] * len(self.columns)) +
+            rb"(\r?)$", re.MULTILINE)
+        template = []
+        for i, redacted in enumerate(self.redacted, 1):
+            if redacted:
+                template.append(redaction.encode())
+            else:
+                template.append(r"\g<{}>".format(i).encode())
+        self.template = b",".join(template) + r"\g<{}>".format(
+            len(self.columns) + 1).encode()
+
+    def redact(self, chunk: bytes) -> bytes:
+        """Redacts a chunk of whole CSV lines
+
+        Chunks with lines the line pattern cannot match (wrong number of
+        columns, blank lines...) go through the `csv` module instead, so
+        no line is ever left unredacted.
+        """
+        lines = chunk.count(b"\n")
+        if not chunk.endswith(b"\n"):
+            lines += 1
+        redacted, count = self.pattern.subn(self.template, chunk)
+        if count == lines:
+            return redacted
+        return self.redact_slow(chunk)
+
+    def redact_slow(self, chunk: bytes) -> bytes:
+        """Redacts a chunk of CSV records field by field
+
+        Kept fields and line endings are copied as written, like the
+        line pattern does, so the output doesn't depend on the path a
+        chunk took. Blank lines are kept blank.
+        """
+        redaction = self.redaction.encode()
+        redacted = self.redacted
+        output = []
+        pos = 0
+        while pos < len(chunk):
+            fields = []
+            while True:
+                field = RAW_FIELD.match(chunk, pos)
+                fields.append(field.group())
+                pos = field.end()
+                if chunk[pos:pos + 1] != b",":
+                    break
+                pos += 1
+            line_end = LINE_END.match(chunk, pos)
+            pos = line_end.end()
+            if fields != [b""]:
+                output.append(b",".join(
+                    redaction if i < len(redacted) and redacted[i]
+                    else value for i, value in enumerate(fields)))
+            output.append(line_end.group())
+        return b"".join(output)
+
+
+def record_end(data: mmap.mmap, start: int, pos: int) -> int:
+    """Returns the offset right after the first newline from `pos` that
+    ends a record, for records starting at `start`
+
+    A newline inside a quoted field follows an odd number of quotes
+    since the start of the record; escaped quotes come in pairs.
+    """
+    quotes = data[start:pos].count(b'"')
+    while True:
+        end = data.find(b"\n", pos)
+        if end == -1:
+            return len(data)
+        quotes += data[pos:end].count(b'"')
+        if quotes % 2 == 0:
+            return end + 1
+        pos = end + 1
+
+
+def chunk_bounds(data: mmap.mmap, start: int,
+                 chunk_size: int) -> Iterator[Tuple[int, int]]:
+    """Yields the (start, end) offsets of chunks of `data` of about
+    `chunk_size` bytes, each ending on a record boundary
+    """
+    size = len(data)
+    while start < size:
+        end = record_end(data, start, min(start + chunk_size, size) - 1)
+        yield start, end
+        start = end
+
+
+def init_worker(header: bytes, fields: Tuple[str, ...],
+                redaction: str) -> None:
+    """Builds the redactor of a worker process"""
+    global _worker
+    _worker = ChunkRedactor(header, fields, redaction)
+
+
+def redact_chunk(task: Tuple[str, int, int]) -> bytes:
+    """Redacts the bytes `start` to `end` of the file at `path`"""
+    path, start, end = task
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return _worker.redact(data[start:end])
+
+
+def redact_file(path: str, output: BinaryIO,
+                workers: Optional[int] = None,
+                chunk_size: int = CHUNK_SIZE,
+                fields: Tuple[str, ...] = PII_FIELDS,
+                redaction: str = RedactingFormatter.REDACTION) -> int:
+    """
+    Redacts a CSV file chunk by chunk in a process pool
+
+    Args:
+    `path`      : the CSV file to redact, with a header line
+    `output`    : where the redacted CSV is written, in input order
+    `workers`   : the number of worker processes (default: CPU count)
+    `chunk_size`: the approximate size of each chunk, in bytes
+    `fields`    : the columns to redact
+    `redaction` : what redacted values are replaced by
+
+    Return: The number of bytes read
+    """
+    if os.path.getsize(path) == 0:
+        return 0
+    workers = workers or os.cpu_count() or 1
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            header_end = record_end(data, 0, 0)
+            header = data[:header_end]
+            output.write(header)
+            bounds = list(chunk_bounds(data, header_end, chunk_size))
+            size = len(data)
+    pending = deque()
+    with Pool(workers, init_worker,
+              (header.rstrip(b"\r\n"), fields, redaction)) as pool:
+        # Keeps a bounded number of chunks in flight and writes the
+        # results back in input order
+        for start, end in bounds:
+            if len(pending) >= 2 * workers:
+                output.write(pending.popleft().get())
+            pending.append(pool.apply_async(redact_chunk,
+                                            ((path, start, end),)))
+        while pending:
+            output.write(pending.popleft().get())
+    output.flush()
+    return size
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    """Redacts a CSV dump from the command line"""
+    parser = argparse.ArgumentParser(
+        description="Redact the PII columns of a CSV dump")
+    parser.add_argument("input", help="CSV file with a header line")
+    parser.add_argument("-o", "--output",
+                        help="file to write to (default: stdout)")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="worker processes (default: CPU count)")
+    parser.add_argument("-c", "--chunk-size", type=int,
+                        default=CHUNK_SIZE >> 20,
+                        help="chunk size in MiB")
+    args = parser.parse_args(argv)
+    chunk_size = args.chunk_size << 20
+    if args.output is None:
+        redact_file(args.input, sys.stdout.buffer, args.workers, chunk_size)
+        return
+    with open(args.output, "wb", buffering=WRITE_BUFFER_SIZE) as output:
+        redact_file(args.input, output, args.workers, chunk_size)
+
+
+if __name__ == "__main__":
+    main()
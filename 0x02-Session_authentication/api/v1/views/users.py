@@ -2,18 +2,82 @@
 """ Module of Users views
 """
 from api.v1.views import app_views
-from flask import abort, jsonify, request
+from flask import Response, abort, jsonify, request
 from models.user import User
+from typing import Iterable, Iterator
+from urllib.parse import quote
+
+STREAM_BATCH_SIZE = 100
+
+
+def iter_users(after: str = None, limit: int = None) -> Iterator[User]:
+    """ Yield users ordered by ID, `STREAM_BATCH_SIZE` at a time
+    """
+    while limit is None or limit > 0:
+        size = STREAM_BATCH_SIZE if limit is None \
+            else min(limit, STREAM_BATCH_SIZE)
+        users = User.page(after, size)
+        if len(users) == 0:
+            return
+        yield from users
+        after = users[-1].id
+        if limit is not None:
+            limit -= len(users)
+
+
+def stream_users(after: str = None, limit: int = None) -> Iterator[str]:
+    """ Yield the JSON list of users piece by piece
+    """
+    yield "["
+    separator = ""
+    for user in iter_users(after, limit):
+        yield separator + user.to_public_json_text()
+        separator = ","
+    yield "]\n"
+
+
+def users_response(users: Iterable[User]) -> Response:
+    """ Return the JSON list of users, as `jsonify` would, made of their
+    cached texts
+    """
+    return Response("[{}]\n".format(
+        ",".join(user.to_public_json_text() for user in users)),
+        mimetype='application/json')
 
 
 @app_views.route('/users', methods=['GET'], strict_slashes=False)
 def view_all_users() -> str:
     """ GET /api/v1/users
+    Query parameters (optional):
+      - limit: maximum number of users
+      - after: ID of the last user of the previous page
+      - stream: 1 to write users as they are serialized
     Return:
-      - list of all User objects JSON represented
+      - list of User objects JSON represented, ordered by ID when paged,
+        with a `Link` header to the next page
+      - 400 if limit isn't a positive integer
     """
-    all_users = [user.to_json() for user in User.all()]
-    return jsonify(all_users)
+    limit = request.args.get('limit')
+    after = request.args.get('after')
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit <= 0:
+            return jsonify({'error': "limit must be a positive integer"}), 400
+    if request.args.get('stream') == "1":
+        return Response(stream_users(after, limit),
+                        mimetype='application/json')
+    if limit is None and after is None:
+        return users_response(User.all())
+    users = User.page(after, None if limit is None else limit + 1)
+    response = users_response(users[:limit])
+    if limit is not None and len(users) > limit:
+        next_url = "{}?limit={}&after={}".format(
+            request.base_url, limit, quote(users[limit - 1].id))
+        response.headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
 
 
 @app_views.route('/users/<user_id>', methods=['GET'], strict_slashes=False)
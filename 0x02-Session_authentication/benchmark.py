@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+""" Storage benchmark
+
+Measures the startup time of `User.load_from_file()` on a synthetic
+dataset, from a JSON snapshot and from a binary one, the time to
+serialize the users for `save_to_file()` and for `GET /api/v1/users`,
+with and without cached conversions, the time to import users one
+`save()` at a time and with `save_many()`, and the memory used per
+object with and without `MODELS_COMPACT`, before and after the JSON
+texts of a save are cached.
+
+Usage: ./benchmark.py [-n users] [-r repeat] [-b bulk users]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import List, Optional
+
+from os import path
+import models
+from models.engine import file_storage
+from models.user import User
+from models.user_session import UserSession
+
+
+def make_users(count: int) -> List[User]:
+    """ Return `count` synthetic users
+    """
+    users = []
+    for i in range(count):
+        user = User(email="user{}@example.com".format(i),
+                    first_name="First{}".format(i),
+                    last_name="Last{}".format(i))
+        user.password = "pwd{}".format(i)
+        users.append(user)
+    return users
+
+
+def make_sessions(count: int, users: int = 1000) -> List[UserSession]:
+    """ Return `count` synthetic sessions of `users` users
+    """
+    return [UserSession(user_id="user-{}".format(i % users),
+                        session_id="session-{}".format(i))
+            for i in range(count)]
+
+
+def measure_memory(count: int):
+    """ Print the bytes allocated per user and per session in the current
+    mode, once created and once saved to file, with their JSON texts
+    cached
+
+    The indexes of the store are left out of the measure.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        for cls, make in ((User, make_users), (UserSession, make_sessions)):
+            tracemalloc.start()
+            objs = make(count)
+            created = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            models.storage.replace(cls, objs)
+            tracemalloc.start()
+            cls.save_to_file()
+            saved = created + tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(created / count)
+            print(saved / count)
+        os.chdir("/")
+
+
+def memory_per_object(count: int, compact: bool) -> List[float]:
+    """ Bytes per user and per session, created and saved, measured in
+    a process with `MODELS_COMPACT` set to `compact`
+    """
+    env = dict(os.environ, MODELS_COMPACT="1" if compact else "0")
+    output = subprocess.run(
+        [sys.executable, path.abspath(__file__), "--measure-memory",
+         "-n", str(count)], env=env, check=True, capture_output=True,
+        text=True).stdout
+    return [float(line) for line in output.split()]
+
+
+def clear_json_caches():
+    """ Make every user convert itself to JSON again
+    """
+    for user in User.all():
+        user.clear_json_cache()
+
+
+def serialization_time(run, cached: bool, repeat: int) -> float:
+    """ Best time of `repeat` calls of `run`, with the conversions
+    cached by a save or not
+    """
+    if cached:
+        User.save_to_file()
+    best = float("inf")
+    for _ in range(repeat):
+        if not cached:
+            clear_json_caches()
+        start = time.perf_counter()
+        run()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def list_users():
+    """ Serialize the users like `GET /api/v1/users`
+    """
+    return "[{}]".format(",".join(
+        user.to_public_json_text() for user in User.all()))
+
+
+def import_time(count: int, bulk: bool) -> float:
+    """ Time to save `count` new users into an empty store, one at a
+    time or with `save_many()`
+    """
+    models.storage.replace(User, [])
+    User.save_to_file()
+    users = [User(email="bulk{}@example.com".format(i))
+             for i in range(count)]
+    start = time.perf_counter()
+    if bulk:
+        User.save_many(users)
+    else:
+        for user in users:
+            user.save()
+    models.storage.flush()
+    return time.perf_counter() - start
+
+
+def load_time(snapshot_format: str, repeat: int) -> float:
+    """ Best time of `repeat` loads of the snapshot in `snapshot_format`
+    """
+    file_storage.STORAGE_FORMAT = snapshot_format
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        User.load_from_file()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(argv: Optional[List[str]] = None):
+    """ Run the benchmark
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark the startup time of the file store")
+    parser.add_argument("-n", "--users", type=int, default=100000,
+                        help="number of users")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="loads per format, the best one is kept")
+    parser.add_argument("-b", "--bulk", type=int, default=2000,
+                        help="number of users imported by save()")
+    parser.add_argument("--measure-memory", action="store_true",
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.measure_memory:
+        measure_memory(args.users)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        models.storage.replace(User, make_users(args.users))
+        times = {}
+        for snapshot_format in file_storage.SNAPSHOT_FILES:
+            file_storage.STORAGE_FORMAT = snapshot_format
+            User.save_to_file()
+        for snapshot_format, file_name in file_storage.SNAPSHOT_FILES.items():
+            times[snapshot_format] = load_time(snapshot_format, args.repeat)
+            size = os.path.getsize(file_name.format("User"))
+            print("{:<7} {:>8.3f}s {:>12,.0f} users/sec {:>6.1f} MB".format(
+                snapshot_format, times[snapshot_format],
+                args.users / times[snapshot_format], size / 1e6))
+            assert User.count() == args.users
+        print("binary speedup: {:.2f}x".format(
+            times["json"] / times["binary"]))
+
+        file_storage.STORAGE_FORMAT = "json"
+        for name, run in (("save_to_file", User.save_to_file),
+                          ("GET /users", list_users)):
+            uncached = serialization_time(run, False, args.repeat)
+            cached = serialization_time(run, True, args.repeat)
+            print("{:<12} {:>8.3f}s, {:>8.3f}s cached ({:.2f}x)".format(
+                name, uncached, cached, uncached / cached))
+
+        one_by_one = import_time(args.bulk, False)
+        bulk = import_time(args.bulk, True)
+        print("import {} users {:>8.3f}s, {:>8.3f}s save_many ({:.0f}x)"
+              .format(args.bulk, one_by_one, bulk, one_by_one / bulk))
+
+    default = memory_per_object(args.users, False)
+    compact = memory_per_object(args.users, True)
+    for i, name in enumerate(("User", "UserSession")):
+        for j, state in enumerate(("created", "saved")):
+            k = 2 * i + j
+            print("{:<12} {:<8} {:>6.0f} bytes/object, {:>6.0f} compact "
+                  "({:.0%})".format(name, state, default[k], compact[k],
+                                    compact[k] / default[k]))
+
+
+if __name__ == "__main__":
+    main()
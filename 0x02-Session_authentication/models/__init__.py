@@ -0,0 +1,11 @@
+#!/usr/bin/env python3
+""" Models package: `storage` is the engine selected by `STORAGE_ENGINE`
+"""
+from os import getenv
+
+if getenv("STORAGE_ENGINE", "file") == "sqlite":
+    from models.engine.db_storage import DBStorage
+    storage = DBStorage()
+else:
+    from models.engine.file_storage import FileStorage
+    storage = FileStorage()
@@ -1,37 +1,107 @@
 #!/usr/bin/env python3
 """ Base module
 """
-from datetime import datetime
-from typing import TypeVar, List, Iterable
-from os import path
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import TypeVar, List, Iterable, Iterator
+from os import getenv
 import json
+import models
+import sys
+import threading
 import uuid
 
 
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%S"
-DATA = {}
+TIMESTAMP_ATTRIBUTES = ('created_at', 'updated_at')
+EPOCH = datetime(1970, 1, 1)
+# Compact models: attributes in __slots__, timestamps as integers and
+# repeated strings interned
+COMPACT_MODELS = getenv("MODELS_COMPACT", "0") == "1"
+# Number of objects keeping their JSON text until they change; the
+# oldest texts are dropped first
+JSON_CACHE_SIZE = int(getenv("MODELS_JSON_CACHE_SIZE", 10000))
+SLOT_ATTRIBUTES = {}
+# id() of the objects with a cached JSON text, oldest first
+JSON_CACHED = OrderedDict()
+
+_json_cache_lock = threading.Lock()
+
+
+def to_datetime(value) -> datetime:
+    """ Convert a stored timestamp: a string in `TIMESTAMP_FORMAT` or
+    seconds since the epoch
+    """
+    if type(value) is int:
+        return EPOCH + timedelta(seconds=value)
+    return datetime.strptime(value, TIMESTAMP_FORMAT)
+
+
+class EpochTimestamp():
+    """ Datetime attribute of compact models, stored in the slot
+    `_<name>` as microseconds since the epoch
+    """
+
+    def __set_name__(self, owner: type, name: str):
+        """ Bind the descriptor to its slot
+        """
+        self.slot = "_" + name
+
+    def __get__(self, obj: TypeVar('Base'), objtype: type = None):
+        """ Return the timestamp as a datetime
+        """
+        if obj is None:
+            return self
+        value = getattr(obj, self.slot)
+        if type(value) is int:
+            return EPOCH + timedelta(microseconds=value)
+        return value
+
+    def __set__(self, obj: TypeVar('Base'), value):
+        """ Store a datetime as an integer
+        """
+        if type(value) is datetime:
+            value = (value - EPOCH) // timedelta(microseconds=1)
+        setattr(obj, self.slot, value)
 
 
 class Base():
     """ Base class
     """
+    # Attributes with a secondary hash index, for equality searches
+    indexed_attributes = ()
+    # Attributes with a sorted index, for ranges and ordering in queries
+    sorted_attributes = ('created_at', 'updated_at')
+    # String attributes interned in compact mode, for values shared
+    # by many objects
+    interned_attributes = ()
+    if COMPACT_MODELS:
+        __slots__ = ('id', '_created_at', '_updated_at', '_json_cache')
+        created_at = EpochTimestamp()
+        updated_at = EpochTimestamp()
+
+    def __setattr__(self, name: str, value):
+        """ Set an attribute, which makes the cached JSON out of date
+
+        In compact mode, the values of `interned_attributes` are
+        interned.
+        """
+        if COMPACT_MODELS and type(value) is str and \
+                name in self.interned_attributes:
+            value = sys.intern(value)
+        object.__setattr__(self, name, value)
+        object.__setattr__(self, '_json_cache', None)
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a Base instance
         """
-        s_class = str(self.__class__.__name__)
-        if DATA.get(s_class) is None:
-            DATA[s_class] = {}
-
-        self.id = kwargs.get('id', str(uuid.uuid4()))
+        self.id = kwargs['id'] if 'id' in kwargs else str(uuid.uuid4())
         if kwargs.get('created_at') is not None:
-            self.created_at = datetime.strptime(kwargs.get('created_at'),
-                                                TIMESTAMP_FORMAT)
+            self.created_at = to_datetime(kwargs.get('created_at'))
         else:
             self.created_at = datetime.utcnow()
         if kwargs.get('updated_at') is not None:
-            self.updated_at = datetime.strptime(kwargs.get('updated_at'),
-                                                TIMESTAMP_FORMAT)
+            self.updated_at = to_datetime(kwargs.get('updated_at'))
         else:
             self.updated_at = datetime.utcnow()
 
@@ -44,11 +114,42 @@ class Base():
             return False
         return (self.id == other.id)
 
+    def stored_items(self) -> Iterable[tuple]:
+        """ Return the (name, value) pairs of the object attributes
+        """
+        if not COMPACT_MODELS:
+            return [item for item in self.__dict__.items()
+                    if item[0] != '_json_cache']
+        items = []
+        for name in self.__class__.slot_attributes():
+            try:
+                items.append((name, getattr(self, name)))
+            except AttributeError:
+                continue
+        return items
+
+    @classmethod
+    def slot_attributes(cls) -> List[str]:
+        """ Names of the attributes held in the slots of a compact model
+        """
+        names = SLOT_ATTRIBUTES.get(cls)
+        if names is None:
+            names = []
+            for klass in reversed(cls.__mro__):
+                for slot in klass.__dict__.get('__slots__', ()):
+                    if slot == '_json_cache':
+                        continue
+                    if slot[1:] in TIMESTAMP_ATTRIBUTES:
+                        slot = slot[1:]
+                    names.append(slot)
+            SLOT_ATTRIBUTES[cls] = names
+        return names
+
     def to_json(self, for_serialization: bool = False) -> dict:
         """ Convert the object a JSON dictionary
         """
         result = {}
-        for key, value in self.__dict__.items():
+        for key, value in self.stored_items():
             if not for_serialization and key[0] == '_':
                 continue
             if type(value) is datetime:
@@ -57,81 +158,158 @@ class Base():
                 result[key] = value
         return result
 
+    def to_json_text(self, cache: bool = True) -> str:
+        """ Return `to_json(True)` encoded in JSON
+
+        The text is cached until an attribute is set, for up to
+        `JSON_CACHE_SIZE` objects; `cache` False only reads the cache.
+        """
+        cached = getattr(self, '_json_cache', None)
+        if type(cached) is list:
+            return cached[0]
+        if not cache or JSON_CACHE_SIZE <= 0:
+            return json.dumps(self.to_json(True))
+        # Setting an attribute meanwhile replaces the token, and the
+        # text, out of date, isn't cached
+        token = object()
+        object.__setattr__(self, '_json_cache', token)
+        text = json.dumps(self.to_json(True))
+        with _json_cache_lock:
+            if getattr(self, '_json_cache', None) is token:
+                # [text, public text, made on first use]
+                object.__setattr__(self, '_json_cache', [text, None])
+                JSON_CACHED.pop(id(self), None)
+                JSON_CACHED[id(self)] = self
+                while len(JSON_CACHED) > JSON_CACHE_SIZE:
+                    _, obj = JSON_CACHED.popitem(last=False)
+                    object.__setattr__(obj, '_json_cache', None)
+        return text
+
+    def to_public_json_text(self) -> str:
+        """ Return `to_json()` encoded like `jsonify` does, with sorted
+        keys and no spaces
+
+        An object with a cached text gets its public text made from it
+        once, and cached along with it.
+        """
+        cached = getattr(self, '_json_cache', None)
+        if type(cached) is not list:
+            return json.dumps(self.to_json(), sort_keys=True,
+                              separators=(",", ":"))
+        if cached[1] is None:
+            result = json.loads(cached[0])
+            cached[1] = json.dumps(
+                {key: value for key, value in result.items()
+                 if key[0] != '_'}, sort_keys=True, separators=(",", ":"))
+        return cached[1]
+
+    def clear_json_cache(self):
+        """ Drop the cached JSON of the object, and the reference the
+        cache holds to it
+        """
+        with _json_cache_lock:
+            JSON_CACHED.pop(id(self), None)
+            object.__setattr__(self, '_json_cache', None)
+
+    def to_record(self) -> dict:
+        """ Convert the object to a binary snapshot record: like
+        `to_json(True)`, with timestamps in seconds since the epoch
+        """
+        result = dict(self.stored_items())
+        for key in TIMESTAMP_ATTRIBUTES:
+            if type(result.get(key)) is datetime:
+                result[key] = (result[key] - EPOCH) // timedelta(seconds=1)
+        return result
+
     @classmethod
     def load_from_file(cls):
-        """ Load all objects from file
+        """ Load all objects from the storage engine
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        DATA[s_class] = {}
-        if not path.exists(file_path):
-            return
-
-        with open(file_path, 'r') as f:
-            objs_json = json.load(f)
-            for obj_id, obj_json in objs_json.items():
-                DATA[s_class][obj_id] = cls(**obj_json)
+        models.storage.load(cls)
 
     @classmethod
     def save_to_file(cls):
         """ Save all objects to file
         """
-        s_class = cls.__name__
-        file_path = ".db_{}.json".format(s_class)
-        objs_json = {}
-        for obj_id, obj in DATA[s_class].items():
-            objs_json[obj_id] = obj.to_json(True)
-
-        with open(file_path, 'w') as f:
-            json.dump(objs_json, f)
+        models.storage.dump(cls)
 
     def save(self):
         """ Save current object
         """
-        s_class = self.__class__.__name__
         self.updated_at = datetime.utcnow()
-        DATA[s_class][self.id] = self
-        self.__class__.save_to_file()
+        models.storage.save(self)
 
     def remove(self):
         """ Remove object
         """
-        s_class = self.__class__.__name__
-        if DATA[s_class].get(self.id) is not None:
-            del DATA[s_class][self.id]
-            self.__class__.save_to_file()
+        models.storage.remove(self)
+
+    @classmethod
+    def save_many(cls, objs: Iterable[TypeVar('Base')]):
+        """ Save objects, persisting them at once
+        """
+        objs = list(objs)
+        now = datetime.utcnow()
+        for obj in objs:
+            obj.updated_at = now
+        models.storage.save_many(cls, objs)
+
+    @classmethod
+    def remove_many(cls, ids: Iterable[str]) -> int:
+        """ Remove objects by ID, persisting them at once, and return
+        how many were found
+        """
+        return models.storage.remove_many(cls, ids)
+
+    @staticmethod
+    def transaction():
+        """ Context manager grouping the saves and removals of the
+        block into one write
+        """
+        return models.storage.transaction()
 
     @classmethod
     def count(cls) -> int:
         """ Count all objects
         """
-        s_class = cls.__name__
-        return len(DATA[s_class].keys())
+        return models.storage.count(cls)
 
     @classmethod
     def all(cls) -> Iterable[TypeVar('Base')]:
         """ Return all objects
         """
-        return cls.search()
+        return models.storage.all(cls)
 
     @classmethod
     def get(cls, id: str) -> TypeVar('Base'):
         """ Return one object by ID
         """
-        s_class = cls.__name__
-        return DATA[s_class].get(id)
+        return models.storage.get(cls, id)
+
+    @classmethod
+    def page(cls, after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Return up to `limit` objects ordered by ID, starting after
+        the ID `after`
+        """
+        return models.storage.page(cls, after, limit)
 
     @classmethod
     def search(cls, attributes: dict = {}) -> List[TypeVar('Base')]:
         """ Search all objects with matching attributes
         """
-        s_class = cls.__name__
-        def _search(obj):
-            if len(attributes) == 0:
-                return True
-            for k, v in attributes.items():
-                if (getattr(obj, k) != v):
-                    return False
-            return True
-        
-        return list(filter(_search, DATA[s_class].values()))
+        return models.storage.search(cls, attributes)
+
+    @classmethod
+    def query(cls, filters: dict = {}, order_by: str = None,
+              limit: int = None, offset: int = 0) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects matching `filters`, ordered by
+        `order_by`, skipping `offset` of them and up to `limit`
+
+        `filters` maps attributes to values, with an optional operator
+        suffix: `__ne`, `__lt`, `__lte`, `__gt`, `__gte` or `__in`
+        (default: equality). `order_by` is an attribute, prefixed with
+        `-` for a descending order. Objects are fetched as the iteration
+        goes.
+        """
+        return models.storage.query(cls, filters, order_by, limit, offset)
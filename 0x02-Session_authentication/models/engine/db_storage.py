@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+""" SQLite storage engine: objects stay on disk, in `STORAGE_DB`
+"""
+from contextlib import contextmanager
+from datetime import datetime
+from os import getenv
+from typing import TypeVar, List, Iterable, Iterator, Tuple
+import json
+import sqlite3
+import threading
+from models import base
+from models.engine.file_storage import FileStorage
+from models.engine.storage import Storage, parse_filters, parse_order
+
+
+DB_PATH = getenv("STORAGE_DB", ".db.sqlite3")
+# Columns of every table, besides the indexed attributes of the class
+# and the `data` column holding the object as JSON
+COLUMNS = ('id', 'created_at', 'updated_at')
+SCALAR_TYPES = (str, int, float, bool)
+# "IS NOT" also matches NULL, like `!=` does in Python
+SQL_OPERATORS = {"eq": "=", "ne": "IS NOT", "lt": "<", "lte": "<=",
+                 "gt": ">", "gte": ">="}
+QUERY_BATCH_SIZE = 100
+
+
+class DBStorage(Storage):
+    """ Storage engine keeping objects in a SQLite database
+
+    Each class has a table with a column, and an index, per attribute
+    of `indexed_attributes` and `sorted_attributes`. The database is in
+    WAL mode, so readers don't wait for writers. Each thread has its own
+    connection.
+    """
+
+    def __init__(self, db_path: str = DB_PATH):
+        """ Initialize a DBStorage instance
+        """
+        self.db_path = db_path
+        self._local = threading.local()
+        self._tables = set()
+
+    def connection(self) -> sqlite3.Connection:
+        """ Return the connection of the current thread
+        """
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.db_path, timeout=30,
+                                         isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    @staticmethod
+    def columns(cls: type) -> List[str]:
+        """ Return the columns of the table of a class
+        """
+        columns = list(COLUMNS)
+        for attr in cls.indexed_attributes + cls.sorted_attributes:
+            if attr not in columns:
+                columns.append(attr)
+        return columns
+
+    def table(self, cls: type) -> str:
+        """ Create the table of a class if needed, and return its name
+        """
+        s_class = cls.__name__
+        if s_class in self._tables:
+            return s_class
+        columns = self.columns(cls)
+        connection = self.connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS "{}" (id TEXT PRIMARY KEY, {}, '
+            'data TEXT NOT NULL)'.format(s_class, ", ".join(
+                '"{}"'.format(column) for column in columns[1:])))
+        for column in cls.indexed_attributes + cls.sorted_attributes:
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS "{0}_{1}" ON "{0}" ("{1}")'
+                .format(s_class, column))
+        self._tables.add(s_class)
+        return s_class
+
+    def load(self, cls: type):
+        """ Create the table of a class
+
+        The first time, the objects of the file storage (snapshot and
+        journal) are imported into it, and the import is recorded in the
+        `imports` table, so objects removed since don't come back. A
+        table filled before imports were recorded isn't imported into.
+        """
+        table = self.table(cls)
+        connection = self.connection()
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS imports (class TEXT PRIMARY KEY)')
+        with self.transaction():
+            if connection.execute('SELECT 1 FROM imports WHERE class = ?',
+                                  (table,)).fetchone() is not None:
+                return
+            if connection.execute(
+                    'SELECT 1 FROM "{}" LIMIT 1'.format(table)) \
+                    .fetchone() is None:
+                self.insert(cls, FileStorage.read_files(cls))
+            connection.execute('INSERT INTO imports (class) VALUES (?)',
+                               (table,))
+
+    def insert(self, cls: type, objs: Iterable[TypeVar('Base')]):
+        """ Insert or replace objects of a class, in one transaction
+        """
+        table = self.table(cls)
+        columns = self.columns(cls)
+        with self.transaction():
+            self.connection().executemany(
+                'INSERT OR REPLACE INTO "{}" ({}, data) VALUES ({})'.format(
+                    table, ", ".join('"{}"'.format(c) for c in columns),
+                    ", ".join("?" * (len(columns) + 1))),
+                (self.row(obj, columns) for obj in objs))
+
+    @contextmanager
+    def transaction(self):
+        """ Run the statements of the current thread in one transaction,
+        committed when the outermost block exits, or rolled back if it
+        raises
+        """
+        connection = self.connection()
+        if connection.in_transaction:
+            yield
+            return
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+
+    @staticmethod
+    def row(obj: TypeVar('Base'), columns: List[str]) -> tuple:
+        """ Return the values of the columns of an object
+        """
+        values = []
+        for column in columns:
+            values.append(DBStorage.value(getattr(obj, column, None)))
+        # Objects of the database are short-lived, their text isn't
+        # worth a place in the cache
+        values.append(obj.to_json_text(False))
+        return tuple(values)
+
+    @staticmethod
+    def value(value):
+        """ Convert an attribute value to what is stored in a column
+        """
+        if type(value) is datetime:
+            return value.strftime(base.TIMESTAMP_FORMAT)
+        if value is None or type(value) in SCALAR_TYPES:
+            return value
+        return json.dumps(value)
+
+    @staticmethod
+    def objects(cls: type, rows: Iterable[tuple]) -> List[TypeVar('Base')]:
+        """ Build the objects of a class from rows of their JSON data
+        """
+        return [cls(**json.loads(data)) for data, in rows]
+
+    def save(self, obj: TypeVar('Base')):
+        """ Store an object in the database
+        """
+        self.insert(obj.__class__, [obj])
+
+    def save_many(self, cls: type, objs: Iterable[TypeVar('Base')]):
+        """ Store objects of a class in the database, in one transaction
+        """
+        self.insert(cls, objs)
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object from the database
+        """
+        table = self.table(obj.__class__)
+        self.connection().execute(
+            'DELETE FROM "{}" WHERE id = ?'.format(table), (obj.id,))
+
+    def remove_many(self, cls: type, ids: Iterable[str]) -> int:
+        """ Delete objects of a class by ID, in one transaction, and
+        return how many were found
+        """
+        table = self.table(cls)
+        with self.transaction():
+            return self.connection().executemany(
+                'DELETE FROM "{}" WHERE id = ?'.format(table),
+                ((obj_id,) for obj_id in ids)).rowcount
+
+    def count(self, cls: type) -> int:
+        """ Count all objects of a class
+        """
+        table = self.table(cls)
+        return self.connection().execute(
+            'SELECT COUNT(*) FROM "{}"'.format(table)).fetchone()[0]
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object of a class by ID
+        """
+        table = self.table(cls)
+        objs = self.objects(cls, self.connection().execute(
+            'SELECT data FROM "{}" WHERE id = ?'.format(table), (id,)))
+        return objs[0] if len(objs) > 0 else None
+
+    def page(self, cls: type, after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Return up to `limit` objects ordered by ID, starting after
+        the ID `after`
+        """
+        table = self.table(cls)
+        return self.objects(cls, self.connection().execute(
+            'SELECT data FROM "{}" WHERE id > ? ORDER BY id LIMIT ?'
+            .format(table), ("" if after is None else after,
+                             -1 if limit is None else limit)))
+
+    def search(self, cls: type,
+               attributes: dict = {}) -> List[TypeVar('Base')]:
+        """ Search all objects of a class with matching attributes
+
+        Conditions on the columns use their index, the others are
+        evaluated on the JSON data; the matches are then checked like
+        the file storage does.
+        """
+        table = self.table(cls)
+        columns = self.columns(cls)
+        conditions = []
+        params = []
+        for k, v in attributes.items():
+            column, column_params = self.column(k, columns)
+            if v is None:
+                conditions.append(column + " IS NULL")
+            elif type(v) in SCALAR_TYPES or type(v) is datetime:
+                conditions.append(column + " = ?")
+                column_params = column_params + [self.value(v)]
+            else:
+                continue
+            params += column_params
+        query = 'SELECT data FROM "{}"'.format(table)
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        objs = self.objects(cls, self.connection().execute(query, params))
+        return [obj for obj in objs
+                if all(getattr(obj, k, None) == v
+                       for k, v in attributes.items())]
+
+    @staticmethod
+    def column(attr: str, columns: List[str]) -> Tuple[str, list]:
+        """ Return the SQL expression of an attribute, and its parameters
+        """
+        if attr in columns:
+            return '"{}"'.format(attr), []
+        return "json_extract(data, ?)", ['$."{}"'.format(attr)]
+
+    def query(self, cls: type, filters: dict = {}, order_by: str = None,
+              limit: int = None, offset: int = 0) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects of a class matching `filters`,
+        ordered by `order_by`, skipping `offset` and up to `limit`
+
+        The query runs in SQLite, using the indexes of the columns, and
+        rows are fetched `QUERY_BATCH_SIZE` at a time. Timestamps are
+        compared to the second.
+        """
+        table = self.table(cls)
+        columns = self.columns(cls)
+        conditions = []
+        params = []
+        for attr, op, value in parse_filters(filters):
+            column, column_params = self.column(attr, columns)
+            params += column_params
+            if op == "in":
+                values = [self.value(v) for v in value]
+                conditions.append("{} IN ({})".format(
+                    column, ", ".join("?" * len(values))))
+                params += values
+            elif value is None and op == "eq":
+                conditions.append(column + " IS NULL")
+            else:
+                conditions.append("{} {} ?".format(column, SQL_OPERATORS[op]))
+                params.append(self.value(value))
+        query = 'SELECT data FROM "{}"'.format(table)
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        attr, reverse = parse_order(order_by)
+        if attr is not None:
+            column, column_params = self.column(attr, columns)
+            direction = "DESC" if reverse else "ASC"
+            query += " ORDER BY {0} {1}, id {1}".format(column, direction)
+            params += column_params
+        query += " LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        return self.fetch(cls, query, params)
+
+    def fetch(self, cls: type, query: str,
+              params: list) -> Iterator[TypeVar('Base')]:
+        """ Yield the objects of the rows of a query, as they are fetched
+        """
+        cursor = self.connection().execute(query, params)
+        while True:
+            rows = cursor.fetchmany(QUERY_BATCH_SIZE)
+            if len(rows) == 0:
+                return
+            yield from self.objects(cls, rows)
@@ -0,0 +1,984 @@
+#!/usr/bin/env python3
+""" File storage engine: objects in memory, persisted to .db_<Class>
+files
+"""
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from contextlib import contextmanager
+from itertools import islice
+from typing import TypeVar, List, Iterable, Iterator, Tuple, IO
+from os import getenv, path, remove
+import atexit
+import fcntl
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from models import base
+from models.engine.storage import Storage, matches, parse_filters, \
+    parse_order, select
+
+# Snapshots are "json" (.db_<Class>.json) or "binary" (.db_<Class>.bin,
+# checksummed blocks of records with integer timestamps)
+STORAGE_FORMAT = getenv("STORAGE_FORMAT", "json")
+SNAPSHOT_FILES = {"json": ".db_{}.json", "binary": ".db_{}.bin"}
+BINARY_MAGIC = b"BSNP"
+BINARY_VERSION = 3
+# Binary file header (magic, version), and block header (payload size,
+# CRC-32 of the payload); a block of size 0 ends the file
+BINARY_HEADER = struct.Struct("<4sH")
+BINARY_BLOCK = struct.Struct("<II")
+BINARY_BLOCK_SIZE = 1000
+# "snapshot" rewrites .db_<Class>.json on every change, "journal"
+# appends each change to .db_<Class>.journal
+STORAGE_MODE = getenv("STORAGE_MODE", "snapshot")
+COMPACT_MIN_RECORDS = int(getenv("STORAGE_COMPACT_MIN_RECORDS", 1000))
+# Write-behind: changes are flushed to disk by a background thread
+WRITE_BEHIND = getenv("STORAGE_WRITE_BEHIND", "0") == "1"
+FLUSH_INTERVAL = float(getenv("STORAGE_FLUSH_INTERVAL", 1.0))
+MAX_DIRTY = int(getenv("STORAGE_MAX_DIRTY", 1000))
+# Shared: several processes use the same files; writers lock them and
+# readers reload what other processes changed
+SHARED = getenv("STORAGE_SHARED", "0") == "1"
+QUERY_BATCH_SIZE = 100
+
+# Permissions of new files, read once as os.umask() can only be read
+# by setting it
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+
+
+def index_bounds(keys: list, conditions: List[tuple]) -> Tuple[int, int]:
+    """ Return the slice of a sorted index matching the (operator,
+    value) conditions on its attribute
+    """
+    start, end = 0, len(keys)
+    try:
+        for op, value in conditions:
+            if op in ("gt", "gte", "eq"):
+                bound = bisect_right if op == "gt" else bisect_left
+                start = max(start, bound(keys, value))
+            if op in ("lt", "lte", "eq"):
+                bound = bisect_left if op == "lt" else bisect_right
+                end = min(end, bound(keys, value))
+    except TypeError:
+        return 0, 0
+    return start, end
+
+
+@contextmanager
+def atomic_write(file_path: str, mode: str = 'w') -> IO:
+    """ Open a temporary file to replace `file_path` with
+
+    Once the block exits, the file is fsynced and renamed over
+    `file_path`, so readers see either the old or the new content,
+    never a partial one. On error, the temporary file is removed. The
+    file keeps the permissions of the one it replaces, or gets those
+    of a new file.
+    """
+    directory = path.dirname(path.abspath(file_path))
+    try:
+        permissions = os.stat(file_path).st_mode & 0o7777
+    except FileNotFoundError:
+        permissions = 0o666 & ~UMASK
+    fd, tmp_path = tempfile.mkstemp(dir=directory,
+                                    prefix=path.basename(file_path) + ".")
+    try:
+        # mkstemp() creates the file readable by its owner only
+        os.fchmod(fd, permissions)
+        with open(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if path.exists(tmp_path):
+            remove(tmp_path)
+        raise
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def file_signature(file_path: str) -> tuple:
+    """ Return what changes when a file is replaced or written to, or
+    None if it doesn't exist
+    """
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ReadWriteLock():
+    """ Lock shared by any number of readers, or held by one writer
+
+    Waiting writers go before new readers, so that a steady flow of
+    reads can't starve them. A thread may take the lock again while
+    holding it, and read while it writes.
+    """
+
+    def __init__(self):
+        """ Initialize a ReadWriteLock instance
+        """
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    @contextmanager
+    def read(self):
+        """ Hold the lock as a reader
+        """
+        local = self._local
+        depth = getattr(local, "reads", 0)
+        if depth > 0 or self._writer == threading.get_ident():
+            local.reads = depth + 1
+            try:
+                yield
+            finally:
+                local.reads = depth
+            return
+        with self._condition:
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+        local.reads = 1
+        try:
+            yield
+        finally:
+            local.reads = 0
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        """ Hold the lock as the only writer
+        """
+        me = threading.get_ident()
+        if self._writer == me:
+            yield
+            return
+        if getattr(self._local, "reads", 0) > 0:
+            raise RuntimeError("Cannot write while holding a read lock")
+        with self._condition:
+            self._waiting_writers += 1
+            while self._writer is not None or self._readers:
+                self._condition.wait()
+            self._waiting_writers -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writer = None
+                self._condition.notify_all()
+
+
+class FileStorage(Storage):
+    """ Storage engine keeping every object in memory
+
+    Each class has its objects by ID, a hash index per attribute of
+    `indexed_attributes`, and sorted indexes of `id` and of the
+    `sorted_attributes`, built on first use. Saves and removals are
+    marked pending, then written to a snapshot or a journal. Reads
+    share the store lock, changes in memory hold it exclusively; files
+    are written outside of it.
+    """
+
+    def __init__(self):
+        """ Initialize a FileStorage instance
+        """
+        self._local = threading.local()
+        self._objects = defaultdict(dict)
+        self._indexes = {}
+        self._indexed_values = {}
+        self._sorted_ids = {}
+        self._sorted_indexes = {}
+        self._sorted_values = {}
+        self._pending = {}
+        self._snapshot_signatures = {}
+        self._journal_offsets = {}
+        self._journal_records = {}
+        self._store_lock = ReadWriteLock()
+        # Serializes writes to the files; never taken while holding the
+        # store lock
+        self._file_lock = threading.RLock()
+        self._pending_lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._flusher = None
+
+    def load(self, cls: type):
+        """ Load all objects of a class from file
+
+        A snapshot found only in the other format is loaded, then
+        written again in `STORAGE_FORMAT`.
+        """
+        with self._file_lock, self.locked_files(cls.__name__):
+            if WRITE_BEHIND:
+                self.flush()
+            with self._store_lock.write():
+                converted = self.load_snapshot(cls)
+                self.load_journal(cls)
+                # Changes made since the flush above are still pending
+                self.apply_pending(cls)
+            if converted is not None:
+                self.dump(cls)
+                remove(converted)
+
+    def dump(self, cls: type):
+        """ Save all objects of a class to file
+
+        The snapshot is replaced atomically. In journal mode, it also
+        replaces the journal, which is emptied.
+        """
+        s_class = cls.__name__
+        file_path = SNAPSHOT_FILES[STORAGE_FORMAT].format(s_class)
+        with self._file_lock, self.locked_files(s_class):
+            if STORAGE_FORMAT == "binary":
+                self.write_binary(cls, file_path)
+            else:
+                self.write_json(cls, file_path)
+            self._snapshot_signatures[s_class] = file_signature(file_path)
+            if STORAGE_MODE == "journal":
+                open(".db_{}.journal".format(s_class), 'w').close()
+                self._journal_records[s_class] = 0
+                self._journal_offsets[s_class] = 0
+
+    def replace(self, cls: type, objs: Iterable[TypeVar('Base')]):
+        """ Replace the objects of a class in memory, without persisting
+        them
+        """
+        s_class = cls.__name__
+        with self._store_lock.write():
+            self._objects[s_class] = {obj.id: obj for obj in objs}
+            self._sorted_ids.pop(s_class, None)
+            self.reset_indexes(cls)
+            for obj in self._objects[s_class].values():
+                self.index_object(cls, obj)
+
+    @contextmanager
+    def locked_files(self, s_class: str, exclusive: bool = True):
+        """ Hold the advisory lock on the files of a class, in shared mode
+
+        The lock is shared with the other processes through `flock` on
+        `.db_<Class>.lock`. A thread already holding it doesn't lock
+        again.
+        """
+        held = getattr(self._local, "locked_classes", None)
+        if held is None:
+            held = self._local.locked_classes = set()
+        if not SHARED or s_class in held:
+            yield
+            return
+        fd = os.open(".db_{}.lock".format(s_class), os.O_RDWR | os.O_CREAT,
+                     0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            held.add(s_class)
+            try:
+                yield
+            finally:
+                held.discard(s_class)
+        finally:
+            os.close(fd)
+
+    def files_changed(self, cls: type) -> bool:
+        """ Tell if the files of a class changed since they were last read
+        or written by this process
+        """
+        s_class = cls.__name__
+        snapshot = SNAPSHOT_FILES[STORAGE_FORMAT].format(s_class)
+        if file_signature(snapshot) != \
+                self._snapshot_signatures.get(s_class):
+            return True
+        if STORAGE_MODE != "journal":
+            return False
+        journal = file_signature(".db_{}.journal".format(s_class))
+        size = 0 if journal is None else journal[1]
+        return size != self._journal_offsets.get(s_class, 0)
+
+    def refresh(self, cls: type):
+        """ Reload the changes of other processes, in shared mode
+
+        Checking costs a `stat` of the files, which are only read again
+        if they changed.
+        """
+        if not SHARED or not self.files_changed(cls):
+            return
+        with self.locked_files(cls.__name__, exclusive=False):
+            with self._store_lock.write():
+                if self.files_changed(cls):
+                    self.reload_changes(cls)
+
+    def reload_changes(self, cls: type, changes: List[tuple] = ()):
+        """ Bring the store up to date with the files of a class, keeping
+        the (operation, object) `changes` not persisted yet
+
+        A journal that only grew is replayed from where it was last
+        read; otherwise, everything is loaded again.
+        """
+        s_class = cls.__name__
+        snapshot = SNAPSHOT_FILES[STORAGE_FORMAT].format(s_class)
+        journal = file_signature(".db_{}.journal".format(s_class))
+        offset = self._journal_offsets.get(s_class, 0)
+        if file_signature(snapshot) != \
+                self._snapshot_signatures.get(s_class) \
+                or s_class not in self._objects \
+                or journal is None or journal[1] < offset:
+            self.load_snapshot(cls)
+            offset = 0
+        self.load_journal(cls, offset)
+        self.apply_pending(cls, changes)
+
+    def load_snapshot(self, cls: type) -> str:
+        """ Replace the objects of a class in memory with those of its
+        snapshot
+
+        Return: the path of the snapshot if it must be converted to
+        `STORAGE_FORMAT`, otherwise None
+        """
+        s_class = cls.__name__
+        self._snapshot_signatures[s_class] = file_signature(
+            SNAPSHOT_FILES[STORAGE_FORMAT].format(s_class))
+        objs, converted = self.read_snapshot(cls)
+        self.replace(cls, objs.values())
+        return converted
+
+    def load_journal(self, cls: type, offset: int = 0):
+        """ Apply the changes of a class journaled since the last
+        snapshot, from the byte `offset` of the journal
+        """
+        s_class = cls.__name__
+        changes, size = self.read_journal(cls, offset)
+        if offset == 0:
+            self._journal_records[s_class] = 0
+        self._journal_records[s_class] = \
+            self._journal_records.get(s_class, 0) + len(changes)
+        self._journal_offsets[s_class] = size
+        self.apply(cls, changes)
+
+    def apply_pending(self, cls: type, changes: List[tuple] = ()):
+        """ Apply to the objects just read from the files the (operation,
+        object) `changes` and the pending changes, not persisted yet
+        """
+        with self._pending_lock:
+            changes = list(changes) + \
+                list(self._pending.get(cls, {}).values())
+        self.apply(cls, [(op, obj.id, obj) for op, obj in changes])
+
+    def apply(self, cls: type, changes: List[tuple]):
+        """ Apply (operation, ID, object) changes to the objects of a
+        class in memory, and to their indexes
+        """
+        s_class = cls.__name__
+        objs = self._objects[s_class]
+        for op, obj_id, obj in changes:
+            if op == "save":
+                objs[obj_id] = obj
+                self.index_object(cls, obj)
+            elif objs.pop(obj_id, None) is not None:
+                self.unindex_object(cls, obj_id)
+        if len(changes) > 0:
+            self._sorted_ids.pop(s_class, None)
+
+    @staticmethod
+    def read_files(cls: type) -> List[TypeVar('Base')]:
+        """ Return the objects of a class stored in its files, snapshot
+        and journal, without loading them
+        """
+        objs, _ = FileStorage.read_snapshot(cls)
+        changes, _ = FileStorage.read_journal(cls)
+        for op, obj_id, obj in changes:
+            if op == "save":
+                objs[obj_id] = obj
+            else:
+                objs.pop(obj_id, None)
+        return list(objs.values())
+
+    @staticmethod
+    def read_snapshot(cls: type) -> Tuple[dict, str]:
+        """ Read the objects of the snapshot of a class
+
+        Return: the objects by ID, and the path of the snapshot if it
+        must be converted to `STORAGE_FORMAT`, otherwise None
+        """
+        s_class = cls.__name__
+        objs = {}
+        formats = sorted(SNAPSHOT_FILES, key=lambda f: f != STORAGE_FORMAT)
+        for snapshot_format in formats:
+            file_path = SNAPSHOT_FILES[snapshot_format].format(s_class)
+            if not path.exists(file_path):
+                continue
+            if snapshot_format == "binary":
+                objs_json = FileStorage.read_binary(file_path)
+            else:
+                with open(file_path, 'r') as f:
+                    objs_json = json.load(f).values()
+            for obj_json in objs_json:
+                obj = cls(**obj_json)
+                objs[obj.id] = obj
+            if snapshot_format != STORAGE_FORMAT:
+                return objs, file_path
+            return objs, None
+        return objs, None
+
+    @staticmethod
+    def read_binary(file_path: str) -> Iterable[dict]:
+        """ Read the records of a binary snapshot
+
+        After its header, the file holds blocks of up to
+        `BINARY_BLOCK_SIZE` records sharing the same attributes, each
+        a JSON [attribute names, value lists] pair, preceded by its size
+        and CRC-32, then an empty block. A snapshot that is damaged,
+        truncated or of another version raises a ValueError.
+        """
+        with open(file_path, 'rb') as f:
+            header = f.read(BINARY_HEADER.size)
+            if len(header) != BINARY_HEADER.size or \
+                    BINARY_HEADER.unpack(header) != \
+                    (BINARY_MAGIC, BINARY_VERSION):
+                raise ValueError("Unsupported snapshot format in {}"
+                                 .format(file_path))
+            while True:
+                block = f.read(BINARY_BLOCK.size)
+                if len(block) != BINARY_BLOCK.size:
+                    raise ValueError("Truncated snapshot {}"
+                                     .format(file_path))
+                size, checksum = BINARY_BLOCK.unpack(block)
+                if size == 0:
+                    return
+                payload = f.read(size)
+                if len(payload) != size or zlib.crc32(payload) != checksum:
+                    raise ValueError("Damaged snapshot {}".format(file_path))
+                columns, rows = json.loads(payload)
+                for row in rows:
+                    yield dict(zip(columns, row))
+
+    @staticmethod
+    def read_journal(cls: type, offset: int = 0) -> Tuple[List[tuple], int]:
+        """ Read the changes of a class journaled from the byte `offset`
+        of its journal
+
+        A torn last record, left by a crash during an append, is
+        dropped from the journal.
+
+        Return: the (operation, ID, object) changes, and the size of the
+        journal
+        """
+        file_path = ".db_{}.journal".format(cls.__name__)
+        changes = []
+        if not path.exists(file_path):
+            return changes, offset
+        with open(file_path, 'rb+') as f:
+            f.seek(offset)
+            size = offset
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                obj = None
+                if record["op"] == "save":
+                    obj = cls(**record["obj"])
+                changes.append((record["op"], record["id"], obj))
+                size += len(line)
+            f.truncate(size)
+        return changes, size
+
+    def write_binary(self, cls: type, file_path: str):
+        """ Write all objects of a class to a binary snapshot
+
+        Records are converted and written one block at a time.
+        """
+        with self._store_lock.read():
+            objs = list(self._objects[cls.__name__].values())
+
+        def write_block(f: IO, columns: tuple, rows: list):
+            payload = json.dumps([columns, rows]).encode()
+            f.write(BINARY_BLOCK.pack(len(payload), zlib.crc32(payload)))
+            f.write(payload)
+
+        with atomic_write(file_path, 'wb') as f:
+            f.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION))
+            columns = None
+            rows = []
+            for obj in objs:
+                record = obj.to_record()
+                if tuple(record) != columns or \
+                        len(rows) >= BINARY_BLOCK_SIZE:
+                    if len(rows) > 0:
+                        write_block(f, columns, rows)
+                    columns = tuple(record)
+                    rows = []
+                rows.append(list(record.values()))
+            if len(rows) > 0:
+                write_block(f, columns, rows)
+            f.write(BINARY_BLOCK.pack(0, 0))
+
+    def write_json(self, cls: type, file_path: str):
+        """ Write all objects of a class to a JSON snapshot
+
+        Objects are serialized one at a time, in the same format as
+        `json.dump` of the whole dictionary.
+        """
+        with self._store_lock.read():
+            objs = list(self._objects[cls.__name__].items())
+        # Caching more objects than the cache holds would only evict
+        # the texts just cached
+        cache = len(objs) <= base.JSON_CACHE_SIZE
+        with atomic_write(file_path) as f:
+            f.write("{")
+            separator = ""
+            for obj_id, obj in objs:
+                f.write("{}{}: {}".format(separator, json.dumps(obj_id),
+                                          obj.to_json_text(cache)))
+                separator = ", "
+            f.write("}")
+
+    def save(self, obj: TypeVar('Base')):
+        """ Store an object in memory, and persist it
+        """
+        with self._store_lock.write():
+            self.store(obj)
+        self.persist()
+
+    def save_many(self, cls: type, objs: Iterable[TypeVar('Base')]):
+        """ Store objects in memory, and persist them at once
+        """
+        with self._store_lock.write():
+            for obj in objs:
+                self.store(obj)
+        self.persist()
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object from memory, and persist it
+        """
+        with self._store_lock.write():
+            self.delete(obj.__class__, obj.id)
+        self.persist()
+
+    def remove_many(self, cls: type, ids: Iterable[str]) -> int:
+        """ Delete objects of a class by ID from memory, persist them at
+        once, and return how many were found
+        """
+        with self._store_lock.write():
+            removed = sum(self.delete(cls, obj_id) for obj_id in ids)
+        self.persist()
+        return removed
+
+    def store(self, obj: TypeVar('Base')):
+        """ Put an object in memory and in the indexes, and mark it
+        pending; the store write lock must be held
+        """
+        cls = obj.__class__
+        s_class = cls.__name__
+        objs = self._objects[s_class]
+        if obj.id not in objs and s_class in self._sorted_ids:
+            insort(self._sorted_ids[s_class], obj.id)
+        objs[obj.id] = obj
+        self.index_object(cls, obj)
+        self.write_change(cls, "save", obj)
+
+    def delete(self, cls: type, obj_id: str) -> bool:
+        """ Take an object out of memory and of the indexes, and mark its
+        removal pending; the store write lock must be held
+        """
+        s_class = cls.__name__
+        obj = self._objects[s_class].pop(obj_id, None)
+        if obj is None:
+            return False
+        if s_class in self._sorted_ids:
+            ids = self._sorted_ids[s_class]
+            i = bisect_left(ids, obj_id)
+            if i < len(ids) and ids[i] == obj_id:
+                del ids[i]
+        self.unindex_object(cls, obj_id)
+        # Removed objects would otherwise stay in memory until evicted
+        obj.clear_json_cache()
+        self.write_change(cls, "remove", obj)
+        return True
+
+    def write_change(self, cls: type, op: str, obj: TypeVar('Base')):
+        """ Mark the save or removal of an object pending
+
+        Changes are marked under the store write lock, so they are
+        persisted in the order they were made: by the caller right
+        after, or by the background thread with write-behind.
+        """
+        with self._pending_lock:
+            self._pending.setdefault(cls, {})[obj.id] = (op, obj)
+            dirty = sum(len(changes) for changes in self._pending.values())
+            if WRITE_BEHIND:
+                self._start_flusher()
+        if WRITE_BEHIND and dirty >= MAX_DIRTY:
+            self._flush_event.set()
+
+    def persist(self):
+        """ Write the pending changes, unless write-behind or a
+        transaction of the current thread defers them
+        """
+        if not WRITE_BEHIND and getattr(self._local, "depth", 0) == 0:
+            self.flush()
+
+    def persist_changes(self, cls: type, changes: List[tuple]):
+        """ Persist a group of (operation, object) changes of a class
+
+        In snapshot mode, the whole file is written once. In journal
+        mode, one record per change is appended to the journal, which
+        is then fsynced. The journal is compacted into a new snapshot
+        once it holds more records than both `COMPACT_MIN_RECORDS` and
+        the number of objects, which keeps the cost of a write
+        independent of the size of the dataset.
+        """
+        if STORAGE_MODE != "journal":
+            self.dump(cls)
+            return
+        s_class = cls.__name__
+        records = []
+        for op, obj in changes:
+            # Same as json.dumps({"op": op, "id": obj.id, "obj": ...})
+            record = '{{"op": {}, "id": {}'.format(
+                json.dumps(op), json.dumps(obj.id))
+            if op == "save":
+                record += ', "obj": ' + obj.to_json_text()
+            records.append(record + "}\n")
+        data = "".join(records).encode()
+        with open(".db_{}.journal".format(s_class), 'ab', buffering=0) as f:
+            start = f.seek(0, os.SEEK_END)
+            try:
+                view = memoryview(data)
+                while len(view) > 0:
+                    view = view[f.write(view):]
+                # Made durable like snapshots are, before save() returns
+                os.fsync(f.fileno())
+            except BaseException:
+                # Drop a partial append, which would corrupt the records
+                # appended after it once the changes are written again
+                f.truncate(start)
+                raise
+        self._journal_offsets[s_class] = start + len(data)
+        self._journal_records[s_class] = \
+            self._journal_records.get(s_class, 0) + len(records)
+        if self._journal_records[s_class] > \
+                max(COMPACT_MIN_RECORDS, len(self._objects[s_class])):
+            self.dump(cls)
+
+    @contextmanager
+    def transaction(self):
+        """ Group the saves and removals of the current thread into one
+        write to disk, when the outermost block exits
+
+        Changes are applied in memory as they are made, and visible to
+        other threads right away; they are written even if the block
+        raises, so the files keep matching the memory.
+        """
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        try:
+            yield
+        finally:
+            self._local.depth -= 1
+            self.persist()
+
+    def flush(self):
+        """ Write every pending change to disk
+
+        If a write fails, the changes not written are marked pending again,
+        behind any newer change of the same objects, and the error is
+        raised.
+        """
+        with self._file_lock:
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            unwritten = list(pending.items())
+            try:
+                while len(unwritten) > 0:
+                    cls, changes = unwritten[0]
+                    with self.locked_files(cls.__name__):
+                        if SHARED and self.files_changed(cls):
+                            with self._store_lock.write():
+                                self.reload_changes(
+                                    cls, list(changes.values()))
+                        self.persist_changes(cls, list(changes.values()))
+                    unwritten.pop(0)
+            except BaseException:
+                with self._pending_lock:
+                    for cls, changes in unwritten:
+                        changes.update(self._pending.get(cls, {}))
+                        self._pending[cls] = changes
+                raise
+
+    def _flush_loop(self):
+        """ Flush pending changes every `FLUSH_INTERVAL` seconds, or as
+        soon as `MAX_DIRTY` objects are waiting
+        """
+        while True:
+            self._flush_event.wait(FLUSH_INTERVAL)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    "Flush of pending changes failed, retrying later")
+
+    def _start_flusher(self):
+        """ Start the background flush thread, and flush at exit
+        """
+        if self._flusher is not None:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop,
+                                         name="storage-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.flush)
+
+    def reset_indexes(self, cls: type):
+        """ Empty the secondary indexes of a class
+        """
+        s_class = cls.__name__
+        self._indexes[s_class] = {attr: {}
+                                  for attr in cls.indexed_attributes}
+        self._indexed_values[s_class] = {}
+        self._sorted_indexes.pop(s_class, None)
+        self._sorted_values.pop(s_class, None)
+
+    def index_object(self, cls: type, obj: TypeVar('Base')):
+        """ Add or update an object in the secondary indexes
+        """
+        s_class = cls.__name__
+        if self._indexes.get(s_class) is None:
+            self.reset_indexes(cls)
+        self.unindex_object(cls, obj.id)
+        values = {}
+        for attr, index in self._indexes[s_class].items():
+            value = getattr(obj, attr, None)
+            try:
+                index.setdefault(value, {})[obj.id] = obj
+            except TypeError:
+                # Unhashable values are left out: searches for them
+                # fall back to a scan
+                continue
+            values[attr] = value
+        self._indexed_values[s_class][obj.id] = values
+        if s_class not in self._sorted_indexes:
+            return
+        values = self.sortable_values(cls, obj)
+        for attr, value in values.items():
+            keys, ids = self._sorted_indexes[s_class][attr]
+            i = bisect_left(ids, obj.id, bisect_left(keys, value),
+                            bisect_right(keys, value))
+            keys.insert(i, value)
+            ids.insert(i, obj.id)
+        self._sorted_values[s_class][obj.id] = values
+
+    def unindex_object(self, cls: type, obj_id: str):
+        """ Remove an object from the secondary indexes
+        """
+        s_class = cls.__name__
+        if self._indexed_values.get(s_class) is None:
+            return
+        values = self._indexed_values[s_class].pop(obj_id, {})
+        for attr, value in values.items():
+            bucket = self._indexes[s_class][attr].get(value)
+            if bucket is None:
+                continue
+            bucket.pop(obj_id, None)
+            if len(bucket) == 0:
+                del self._indexes[s_class][attr][value]
+        if s_class not in self._sorted_indexes:
+            return
+        values = self._sorted_values[s_class].pop(obj_id, {})
+        for attr, value in values.items():
+            keys, ids = self._sorted_indexes[s_class][attr]
+            end = bisect_right(keys, value)
+            i = bisect_left(ids, obj_id, bisect_left(keys, value), end)
+            if i < end and ids[i] == obj_id:
+                del keys[i]
+                del ids[i]
+
+    @staticmethod
+    def sortable_values(cls: type, obj: TypeVar('Base')) -> dict:
+        """ Return the values of the `sorted_attributes` of an object,
+        leaving out the None ones
+        """
+        values = {}
+        for attr in cls.sorted_attributes:
+            value = getattr(obj, attr, None)
+            if value is not None:
+                values[attr] = value
+        return values
+
+    def sorted_ids(self, cls: type) -> List[str]:
+        """ Return the IDs of all objects of a class in order
+
+        The list is built on first use, then kept sorted by store() and
+        delete().
+        """
+        s_class = cls.__name__
+        with self._store_lock.read():
+            if s_class not in self._sorted_ids:
+                self._sorted_ids[s_class] = sorted(self._objects[s_class])
+            return self._sorted_ids[s_class]
+
+    def sorted_index(self, cls: type, attr: str) -> tuple:
+        """ Return the sorted index of `id` or of an attribute of
+        `sorted_attributes`, as two lists: the values in order, and the
+        ID of the object of each value
+
+        Objects of equal values are ordered by ID. Indexes are built on
+        first use, then kept up to date by index_object() and
+        unindex_object().
+        """
+        s_class = cls.__name__
+        if attr == 'id':
+            ids = self.sorted_ids(cls)
+            return ids, ids
+        with self._store_lock.read():
+            if s_class not in self._sorted_indexes:
+                entries = {name: [] for name in cls.sorted_attributes}
+                values = {}
+                for obj in self._objects[s_class].values():
+                    values[obj.id] = self.sortable_values(cls, obj)
+                    for name, value in values[obj.id].items():
+                        entries[name].append((value, obj.id))
+                indexes = {}
+                for name, pairs in entries.items():
+                    pairs.sort()
+                    indexes[name] = ([value for value, _ in pairs],
+                                     [obj_id for _, obj_id in pairs])
+                self._sorted_values[s_class] = values
+                self._sorted_indexes[s_class] = indexes
+            return self._sorted_indexes[s_class][attr]
+
+    def count(self, cls: type) -> int:
+        """ Count all objects of a class
+        """
+        self.refresh(cls)
+        with self._store_lock.read():
+            return len(self._objects[cls.__name__].keys())
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object of a class by ID
+        """
+        self.refresh(cls)
+        with self._store_lock.read():
+            return self._objects[cls.__name__].get(id)
+
+    def page(self, cls: type, after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Return up to `limit` objects ordered by ID, starting after
+        the ID `after`
+        """
+        s_class = cls.__name__
+        self.refresh(cls)
+        with self._store_lock.read():
+            ids = self.sorted_ids(cls)
+            start = 0 if after is None else bisect_right(ids, after)
+            end = len(ids) if limit is None else start + limit
+            return [self._objects[s_class][obj_id]
+                    for obj_id in ids[start:end]]
+
+    def search(self, cls: type,
+               attributes: dict = {}) -> List[TypeVar('Base')]:
+        """ Search all objects of a class with matching attributes
+
+        Equality on an indexed attribute is looked up in its index;
+        indexes reflect the attribute values of the last save().
+        """
+        s_class = cls.__name__
+        self.refresh(cls)
+
+        def _search(obj):
+            if len(attributes) == 0:
+                return True
+            for k, v in attributes.items():
+                if (getattr(obj, k) != v):
+                    return False
+            return True
+
+        with self._store_lock.read():
+            candidates = self._objects[s_class].values()
+            indexes = self._indexes.get(s_class, {})
+            for k, v in attributes.items():
+                if k not in indexes:
+                    continue
+                try:
+                    candidates = indexes[k].get(v, {}).values()
+                except TypeError:
+                    continue
+                break
+            return list(filter(_search, candidates))
+
+    def query(self, cls: type, filters: dict = {}, order_by: str = None,
+              limit: int = None, offset: int = 0) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects of a class matching `filters`,
+        ordered by `order_by`, skipping `offset` and up to `limit`
+
+        Objects are walked in the order of a sorted index (`id` or
+        `sorted_attributes`), restricted to the range of the filters on
+        it, when the query is ordered by or filtered on such an
+        attribute and has no equality on a hash-indexed attribute.
+        Otherwise, the candidates are filtered and ordered in Python.
+        """
+        conditions = parse_filters(filters)
+        attr, reverse = parse_order(order_by)
+        walkable = ('id',) + tuple(cls.sorted_attributes)
+        hashed = {a: v for a, op, v in conditions
+                  if op == "eq" and a in cls.indexed_attributes}
+        if attr is None:
+            attr = next((a for a, op, v in conditions
+                         if a in walkable and op not in ("ne", "in")),
+                        None)
+        if len(hashed) > 0 or attr not in walkable:
+            return select(self.search(cls, hashed), conditions, order_by,
+                          limit, offset)
+        objs = (obj for obj in self.walk(cls, attr, conditions, reverse)
+                if matches(obj, conditions))
+        return islice(objs, offset, None if limit is None else offset + limit)
+
+    def walk(self, cls: type, attr: str, conditions: List[tuple],
+             reverse: bool = False) -> Iterator[TypeVar('Base')]:
+        """ Yield the objects of a class in the order of the sorted index
+        of `attr`, within the range of the conditions on it
+
+        The store is read `QUERY_BATCH_SIZE` objects at a time, resuming
+        after the last (value, ID) yielded, so changes made between two
+        batches don't skip or repeat objects.
+        """
+        s_class = cls.__name__
+        bounds = [(op, v) for a, op, v in conditions if a == attr]
+        cursor = None
+        while True:
+            self.refresh(cls)
+            with self._store_lock.read():
+                keys, ids = self.sorted_index(cls, attr)
+                start, end = index_bounds(keys, bounds)
+                if cursor is not None:
+                    lo = bisect_left(keys, cursor[0])
+                    hi = bisect_right(keys, cursor[0])
+                    if reverse:
+                        end = min(end, bisect_left(ids, cursor[1], lo, hi))
+                    else:
+                        start = max(start,
+                                    bisect_right(ids, cursor[1], lo, hi))
+                if start >= end:
+                    return
+                if reverse:
+                    start = max(start, end - QUERY_BATCH_SIZE)
+                    last = start
+                else:
+                    end = min(end, start + QUERY_BATCH_SIZE)
+                    last = end - 1
+                cursor = (keys[last], ids[last])
+                objs = [self._objects[s_class][obj_id]
+                        for obj_id in ids[start:end]]
+            if reverse:
+                objs.reverse()
+            yield from objs
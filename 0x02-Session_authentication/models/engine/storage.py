@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+""" Storage engine interface
+"""
+from contextlib import contextmanager
+from itertools import islice
+from typing import TypeVar, List, Iterable, Iterator, Tuple
+import heapq
+import operator
+
+
+# Operators of query filters, as "<attribute>__<operator>" keys
+OPERATORS = {
+    "eq": operator.eq,
+    "ne": operator.ne,
+    "lt": operator.lt,
+    "lte": operator.le,
+    "gt": operator.gt,
+    "gte": operator.ge,
+    "in": lambda value, values: value in values,
+}
+
+
+def parse_filters(filters: dict) -> List[Tuple[str, str, object]]:
+    """ Split query filters into (attribute, operator, value) conditions
+    """
+    conditions = []
+    for key, value in filters.items():
+        attr, _, op = key.rpartition("__")
+        if attr == "" or op not in OPERATORS:
+            attr, op = key, "eq"
+        conditions.append((attr, op, value))
+    return conditions
+
+
+def parse_order(order_by: str = None) -> Tuple[str, bool]:
+    """ Split `order_by` into the attribute and whether the order is
+    descending
+    """
+    if order_by is None:
+        return None, False
+    if order_by.startswith("-"):
+        return order_by[1:], True
+    return order_by, False
+
+
+def matches(obj, conditions: List[tuple]) -> bool:
+    """ Tell if an object meets every condition; values that can't be
+    compared don't
+    """
+    for attr, op, value in conditions:
+        try:
+            if not OPERATORS[op](getattr(obj, attr, None), value):
+                return False
+        except TypeError:
+            return False
+    return True
+
+
+def select(objs: Iterable, conditions: List[tuple], order_by: str = None,
+           limit: int = None, offset: int = 0) -> Iterator:
+    """ Filter, order and slice objects in Python
+
+    With a limit, only the first `offset + limit` objects are kept
+    while ordering, instead of sorting all of them.
+    """
+    objs = (obj for obj in objs if matches(obj, conditions))
+    attr, reverse = parse_order(order_by)
+    if attr is not None:
+        def key(obj):
+            # None values come first, like NULL values in SQLite
+            value = getattr(obj, attr, None)
+            return (value is not None, value, obj.id)
+        if limit is None:
+            objs = iter(sorted(objs, key=key, reverse=reverse))
+        elif reverse:
+            objs = iter(heapq.nlargest(offset + limit, objs, key=key))
+        else:
+            objs = iter(heapq.nsmallest(offset + limit, objs, key=key))
+    return islice(objs, offset, None if limit is None else offset + limit)
+
+
+class Storage():
+    """ Interface of the storage engines behind Base
+
+    Methods receive the model class, or the object, they work on.
+    """
+
+    def load(self, cls: type):
+        """ Prepare the storage of a class and load its objects
+        """
+        raise NotImplementedError
+
+    def dump(self, cls: type):
+        """ Write all objects of a class at once; engines writing each
+        change as it is made have nothing to do
+        """
+        pass
+
+    def save(self, obj: TypeVar('Base')):
+        """ Store an object
+        """
+        raise NotImplementedError
+
+    def save_many(self, cls: type, objs: Iterable[TypeVar('Base')]):
+        """ Store objects of a class, with as few writes as possible
+        """
+        for obj in objs:
+            self.save(obj)
+
+    def remove(self, obj: TypeVar('Base')):
+        """ Delete an object
+        """
+        raise NotImplementedError
+
+    def remove_many(self, cls: type, ids: Iterable[str]) -> int:
+        """ Delete objects of a class by ID, with as few writes as
+        possible, and return how many were found
+        """
+        removed = 0
+        for obj_id in ids:
+            obj = self.get(cls, obj_id)
+            if obj is not None:
+                self.remove(obj)
+                removed += 1
+        return removed
+
+    @contextmanager
+    def transaction(self):
+        """ Group the changes made in the block into as few writes as
+        possible
+        """
+        yield
+
+    def count(self, cls: type) -> int:
+        """ Count all objects of a class
+        """
+        raise NotImplementedError
+
+    def all(self, cls: type) -> List[TypeVar('Base')]:
+        """ Return all objects of a class
+        """
+        return self.search(cls)
+
+    def get(self, cls: type, id: str) -> TypeVar('Base'):
+        """ Return one object of a class by ID
+        """
+        raise NotImplementedError
+
+    def page(self, cls: type, after: str = None,
+             limit: int = None) -> List[TypeVar('Base')]:
+        """ Return up to `limit` objects ordered by ID, starting after
+        the ID `after`
+        """
+        raise NotImplementedError
+
+    def search(self, cls: type,
+               attributes: dict = {}) -> List[TypeVar('Base')]:
+        """ Search all objects of a class with matching attributes
+        """
+        raise NotImplementedError
+
+    def query(self, cls: type, filters: dict = {}, order_by: str = None,
+              limit: int = None, offset: int = 0) -> Iterator[TypeVar('Base')]:
+        """ Iterate over the objects of a class matching `filters`,
+        ordered by `order_by`, skipping `offset` and up to `limit`
+        """
+        return select(self.all(cls), parse_filters(filters), order_by,
+                      limit, offset)
+
+    def flush(self):
+        """ Write every pending change
+        """
+        pass
@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 """ User Session module
 """
-from models.base import Base
+from models.base import Base, COMPACT_MODELS
 
 
 class UserSession(Base):
     """ User Session class
     """
+    indexed_attributes = ('session_id',)
+    interned_attributes = ('user_id',)
+    if COMPACT_MODELS:
+        __slots__ = ('user_id', 'session_id')
 
     def __init__(self, *args: list, **kwargs: dict):
         """ Initialize a User Session instance
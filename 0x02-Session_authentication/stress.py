@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+""" Store stress test
+
+Runs reader threads (get, search, page, query, count, all) against
+writer threads (save, save_many, remove, remove_many in a transaction,
+load_from_file) on the file store, then checks that no thread failed
+and that the store, its indexes and the files on disk agree.
+
+Usage: ./stress.py [-r readers] [-w writers] [-d seconds] [-n users]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import List, Optional
+
+import models
+from models.user import User
+
+
+def reader(stop: threading.Event, errors: list, seed: int):
+    """ Read the store until `stop` is set
+    """
+    rng = random.Random(seed)
+    try:
+        while not stop.is_set():
+            users = User.all()
+            if len(users) == 0:
+                continue
+            user = rng.choice(users)
+            User.get(user.id)
+            for found in User.search({'email': user.email}):
+                assert found.email == user.email
+            page = User.page(rng.choice((None, user.id)), 50)
+            assert [u.id for u in page] == sorted(u.id for u in page)
+            recent = list(User.query({'created_at__lte': user.created_at},
+                                     "-created_at", 50))
+            keys = [(u.created_at, u.id) for u in recent]
+            assert keys == sorted(keys, reverse=True)
+            # first_name is left None: ordered by ID, like NULLs in SQLite
+            unnamed = [u.id for u in User.query({}, "first_name", 20)]
+            assert unnamed == sorted(unnamed)
+            User.count()
+    except Exception:
+        errors.append(traceback.format_exc())
+
+
+def writer(stop: threading.Event, errors: list, seed: int):
+    """ Create, update, remove users and reload the store until `stop`
+    is set
+    """
+    rng = random.Random(seed)
+    try:
+        while not stop.is_set():
+            action = rng.random()
+            if action < 0.35:
+                user = User(email="{}@example.com".format(rng.random()))
+                user.save()
+            elif action < 0.4:
+                User.save_many(User(email="{}@example.com".format(
+                    rng.random())) for _ in range(5))
+            elif action < 0.99:
+                users = User.all()
+                if len(users) == 0:
+                    continue
+                user = rng.choice(users)
+                if action < 0.7:
+                    user.email = "{}@example.com".format(rng.random())
+                    user.save()
+                elif action < 0.9:
+                    user.remove()
+                else:
+                    with User.transaction():
+                        user.remove()
+                        User.remove_many(u.id for u in rng.sample(
+                            users, min(3, len(users))))
+            else:
+                User.load_from_file()
+    except Exception:
+        errors.append(traceback.format_exc())
+
+
+def check_store() -> List[str]:
+    """ Compare the store with its indexes and with the files on disk
+    """
+    problems = []
+    models.storage.flush()
+    users = {user.id: user for user in User.all()}
+    for user in users.values():
+        if User.search({'email': user.email}).count(user) != 1:
+            problems.append("{} missing from the email index".format(user.id))
+    if models.storage.sorted_ids(User) != sorted(users):
+        problems.append("sorted IDs don't match the store")
+    for attr in User.sorted_attributes:
+        pairs = sorted((getattr(user, attr), obj_id)
+                       for obj_id, user in users.items())
+        if list(zip(*models.storage.sorted_index(User, attr))) != pairs:
+            problems.append("sorted {} index doesn't match".format(attr))
+    User.load_from_file()
+    on_disk = {user.id: user.to_json(True) for user in User.all()}
+    in_memory = {obj_id: user.to_json(True) for obj_id, user in users.items()}
+    if on_disk != in_memory:
+        problems.append("files on disk don't match the store")
+    return problems
+
+
+def main(argv: Optional[List[str]] = None):
+    """ Run the stress test
+    """
+    parser = argparse.ArgumentParser(
+        description="Stress the file store with threads")
+    parser.add_argument("-r", "--readers", type=int, default=8,
+                        help="reader threads")
+    parser.add_argument("-w", "--writers", type=int, default=2,
+                        help="writer threads")
+    parser.add_argument("-d", "--duration", type=float, default=5,
+                        help="duration in seconds")
+    parser.add_argument("-n", "--users", type=int, default=500,
+                        help="initial number of users")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        User.load_from_file()
+        for i in range(args.users):
+            User(email="user{}@example.com".format(i)).save()
+
+        stop = threading.Event()
+        errors = []
+        threads = [threading.Thread(target=reader, args=(stop, errors, i))
+                   for i in range(args.readers)]
+        threads += [threading.Thread(target=writer, args=(stop, errors, i))
+                    for i in range(args.writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(args.duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+        problems = errors + check_store()
+        count = User.count()
+        # Leave the temporary directory with nothing left to flush
+        models.storage.flush()
+        os.chdir("/")
+    for problem in problems:
+        print(problem)
+    print("{} users, {} problems".format(count, len(problems)))
+    if problems:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()